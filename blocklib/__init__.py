@@ -2,12 +2,14 @@ import pkg_resources
 from .pprlindex import PPRLIndex
 from .pprlpsig import PPRLIndexPSignature
 from .pprllambdafold import PPRLIndexLambdaFold
-from .signature_generator import generate_signatures
-from .blocks_generator import generate_blocks, generate_reverse_blocks
+from .signature_generator import generate_signatures, SignaturePlan
+from .blocks_generator import generate_blocks, generate_reverse_blocks, iter_blocks, split_oversized_blocks
 from .validation import validate_signature_config
 from .candidate_blocks_generator import generate_candidate_blocks
-from .encoding import generate_bloom_filter, flip_bloom_filter
-from .evaluation import assess_blocks_2party
+from .encoding import generate_bloom_filter, generate_bloom_filters, flip_bloom_filter
+from .evaluation import assess_blocks_2party, assess_blocks_multiparty, estimate_blocks_2party
+from .pairs import candidate_pairs, iter_candidate_pairs
+from .simjoin import similarity_join, iter_similarity_join
 
 try:
     __version__ = pkg_resources.get_distribution('blocklib').version
@@ -1,12 +1,14 @@
 """Module that implement final block generations."""
-from collections import defaultdict
-from typing import Any, Dict, Sequence, Set, List, cast
-import ast
+from collections import Counter, defaultdict
+import itertools
+from typing import Any, Dict, Iterable, Optional, Sequence, Set, List, cast
 import numpy as np
 
 from blocklib import PPRLIndex
 from .pprlpsig import PPRLIndexPSignature
 from .candidate_blocks_generator import CandidateBlockingResult
+from .encoding import BLOCK_KEY_DTYPE
+from .stats import block_comparisons
 
 
 def check_block_object(candidate_block_objs: Sequence[CandidateBlockingResult]):
@@ -33,6 +35,41 @@ def generate_blocks(candidate_block_objs: Sequence[CandidateBlockingResult], K:
     :param K: it specifies the minimum number of occurrence for records to be included in the final blocks
     :return: filtered_reversed_indices: List of dictionaries, filter out records that appear in less than K parties
     """
+    final_block_keys = select_final_block_keys(candidate_block_objs, K)
+    return [filter_reversed_index(obj.blocks, final_block_keys) for obj in candidate_block_objs]
+
+
+def iter_blocks(candidate_block_objs: Sequence[CandidateBlockingResult], K: int):
+    """
+    Iterate over the final blocks given list of candidate block objects from 2 or more than 2 data providers.
+
+    Unlike generate_blocks, no filtered copies of the reversed indices are made. Only the set of final block keys
+    is held in memory while iterating.
+
+    :param candidate_block_objs: A list of CandidateBlockingResult from multiple data providers
+    :param K: it specifies the minimum number of occurrence for records to be included in the final blocks
+    :return: generator of (block_key, record_ids) tuples, where record_ids holds the list of record IDs of each party
+        in the block, which is empty if the party doesn't have the block. The lists are the ones of the candidate
+        blocks and must not be modified.
+    """
+    remaining_keys = select_final_block_keys(candidate_block_objs, K)
+    reversed_indices = [obj.blocks for obj in candidate_block_objs]
+    no_records = []  # type: List[Any]
+    for reversed_index in reversed_indices:
+        for block_key in reversed_index:
+            if block_key in remaining_keys:
+                remaining_keys.discard(block_key)
+                yield block_key, [other.get(block_key, no_records) for other in reversed_indices]
+
+
+def select_final_block_keys(candidate_block_objs: Sequence[CandidateBlockingResult], K: int):
+    """
+    Return the keys of the final blocks given list of candidate block objects from 2 or more than 2 data providers.
+
+    :param candidate_block_objs: A list of CandidateBlockingResult from multiple data providers
+    :param K: it specifies the minimum number of occurrence for records to be included in the final blocks
+    :return: final_block_keys: set of block keys
+    """
     check_block_object(candidate_block_objs)
     assert len(candidate_block_objs) >= K >= 2
 
@@ -41,23 +78,31 @@ def generate_blocks(candidate_block_objs: Sequence[CandidateBlockingResult], K:
     reversed_indices = [obj.blocks for obj in candidate_block_objs]
     block_states = [obj.state for obj in candidate_block_objs]  # type: Sequence[PPRLIndex]
 
-    filtered_reversed_indices = []  # type: List[Dict[Any, List[Any]]]
     if state_type == PPRLIndexPSignature:
         block_states = cast(Sequence[PPRLIndexPSignature], block_states)
-        filtered_reversed_indices = generate_blocks_psig(reversed_indices, block_states, threshold=K)
+        return select_psig_block_keys(reversed_indices, block_states, threshold=K)
 
     # default strategy: use key in reversed index as block keys
-    else:
-        block_keys = defaultdict(int)  # type: Dict[Any, int]
-        for reversed_index in reversed_indices:
-            for key in reversed_index:
-                block_keys[key] += 1
-        final_block_keys = [key for key, count in block_keys.items() if count >= K]
-        for reversed_index in reversed_indices:
-            reversed_index = {k: v for k, v in reversed_index.items() if k in final_block_keys}
-            filtered_reversed_indices.append(reversed_index)
+    return select_common_block_keys(reversed_indices, K)
 
-    return filtered_reversed_indices
+
+def select_common_block_keys(reversed_indices: Sequence[Dict], threshold: int):
+    """
+    Join the block keys of all parties by hashing.
+    :param reversed_indices: A list of dictionaries where key is the block key and value is a list of record IDs.
+    :param threshold: the minimum number of reversed indices a block key must occur in
+    :return: common_keys: set of block keys that occur in at least threshold reversed indices
+    """
+    counts = Counter(itertools.chain.from_iterable(reversed_indices))
+    return {key for key, count in counts.items() if count >= threshold}
+
+
+def filter_reversed_index(reversed_index: Dict, block_keys: Set):
+    """
+    Return the blocks of reversed_index whose key is in block_keys, in the order of reversed_index.
+    The lists of record IDs are shared with reversed_index, not copied.
+    """
+    return {key: recs for key, recs in reversed_index.items() if key in block_keys}
 
 
 def generate_reverse_blocks(reversed_indices: Sequence[Dict]):
@@ -76,47 +121,126 @@ def generate_reverse_blocks(reversed_indices: Sequence[Dict]):
     return rec_to_blockkey
 
 
+def select_oversized_block_keys(reversed_indices: Sequence[Dict], max_block_size: Optional[int] = None,
+                                max_pairs: Optional[int] = None):
+    """
+    Return the keys of the blocks that exceed a size or pair budget.
+    :param reversed_indices: A list of dictionaries where key is the block key and value is a list of record IDs.
+    :param max_block_size: maximum number of records of a party in a block
+    :param max_pairs: maximum number of record pairs across parties in a block
+    :return: oversized_keys: set of keys of blocks shared by at least 2 parties that exceed either limit
+    """
+    oversized_keys = set()
+    for key, count in Counter(itertools.chain.from_iterable(reversed_indices)).items():
+        if count < 2:
+            continue
+        sizes = [len(reversed_index.get(key, ())) for reversed_index in reversed_indices]
+        if (max_block_size is not None and max(sizes) > max_block_size) or \
+                (max_pairs is not None and block_comparisons(sizes) > max_pairs):
+            oversized_keys.add(key)
+    return oversized_keys
+
+
+def split_oversized_blocks(candidate_block_objs: Sequence[CandidateBlockingResult], datasets: Sequence[Any],
+                           max_block_size: Optional[int] = None, max_pairs: Optional[int] = None,
+                           max_depth: int = 3, headers: Optional[Sequence[Optional[List[str]]]] = None):
+    """
+    Recursively split the blocks that exceed a size or pair budget into sub-blocks.
+
+    Which blocks to split is decided on the blocks of all parties, and every party splits them with the sub-block
+    keys of its blocking method, so matching sub-blocks line up. P-Sig uses the signature strategies of
+    ``split-signatureSpecs`` and Lambda-fold uses ``split-bits`` additional sampled bits.
+    Blocks still exceeding a limit are split again, up to max_depth times, and splitting stops early once a level
+    divides no block, e.g. because the oversized blocks only hold duplicate records.
+
+    :param candidate_block_objs: A list of CandidateBlockingResult from multiple data providers
+    :param datasets: the data each candidate block object was generated from
+    :param max_block_size: maximum number of records of a party in a block
+    :param max_pairs: maximum number of record pairs across parties in a block
+    :param max_depth: maximum number of times a block is split
+    :param headers: file header of each dataset, optional
+    :return: A list of CandidateBlockingResult with the split blocks, to be passed to generate_blocks
+    """
+    check_block_object(candidate_block_objs)
+    if max_block_size is None and max_pairs is None:
+        raise ValueError('Either max_block_size or max_pairs must be given')
+    if len(datasets) != len(candidate_block_objs):
+        raise ValueError('Expected {} datasets, got {}'.format(len(candidate_block_objs), len(datasets)))
+    headers = headers or [None] * len(datasets)
+
+    reversed_indices = [obj.blocks for obj in candidate_block_objs]
+    for level in range(max_depth):
+        oversized_keys = select_oversized_block_keys(reversed_indices, max_block_size, max_pairs)
+        if not oversized_keys:
+            break
+        split_indices = [obj.state.split_blocks(reversed_index, oversized_keys, data, level, header)
+                         for obj, reversed_index, data, header
+                         in zip(candidate_block_objs, reversed_indices, datasets, headers)]
+        # sub-block keys are new keys, so a split only made progress if some party has more blocks than before
+        if all(len(split) <= len(reversed_index) for split, reversed_index in zip(split_indices, reversed_indices)):
+            break
+        reversed_indices = split_indices
+    return [CandidateBlockingResult(reversed_index, obj.state)
+            for reversed_index, obj in zip(reversed_indices, candidate_block_objs)]
+
+
+def block_key_layout(block_keys: Iterable[bytes]):
+    """
+    Lay out the bit positions of P-Sig block keys in compressed sparse row format.
+    :param block_keys: Iterable of block keys, each the bytes of sorted bit positions, e.g. a reversed index
+    :return: A 3-tuple containing
+        the list of block keys
+        offsets, such that the bit positions of block i are positions[offsets[i]:offsets[i + 1]]
+        the concatenated bit positions of all blocks
+    """
+    keys = list(block_keys)
+    lengths = np.fromiter((len(key) for key in keys), dtype=np.int64, count=len(keys)) // BLOCK_KEY_DTYPE.itemsize
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    positions = np.frombuffer(b''.join(keys), dtype=BLOCK_KEY_DTYPE).astype(np.int64)
+    return keys, offsets, positions
+
+
 def generate_blocks_psig(reversed_indices: Sequence[Dict], block_states: Sequence[PPRLIndexPSignature], threshold: int):
     """
     Generate final blocks for P-Sig.
-    :param reversed_indices: A list of dictionaries where key is the block key and value is a list of record IDs.
+    :param reversed_indices: A list of dictionaries where key is the block key, the bytes of sorted bit positions, and
+        value is a list of record IDs.
     :param block_states: A list of PPRLIndex objects that hold configuration of the blocking job
     :param threshold: int which decides a pair when number of 1 bits in bloom filter is large than or equal to threshold
     :return: reversed_indices: A list of dictionaries where blocks that don't contain any matches are deleted
     """
-    # generate candidate bloom filters
-    candidate_bloom_filters = []
-    for reversed_index, state in zip(reversed_indices, block_states):
-        cbf = set()  # type: Set[int]
-        for bf_set in reversed_index:
-            bf_set = ast.literal_eval(bf_set)
-            cbf = cbf.union(bf_set)
+    final_block_keys = select_psig_block_keys(reversed_indices, block_states, threshold)
+    return [filter_reversed_index(reversed_index, final_block_keys) for reversed_index in reversed_indices]
 
-        bf_len = int(block_states[0].blocking_config.get("bf-len", None))
-        bf_vector = np.zeros(bf_len, dtype=bool)
-        bf_vector[list(cbf)] = True
-        candidate_bloom_filters.append(bf_vector)
 
-    # compute blocking filter (and operation)
-    cbf_array = np.sum(candidate_bloom_filters, axis=0)
-    block_filter = cbf_array >= threshold
+def select_psig_block_keys(reversed_indices: Sequence[Dict], block_states: Sequence[PPRLIndexPSignature],
+                           threshold: int):
+    """
+    Return the keys of the final P-Sig blocks.
+    :param reversed_indices: A list of dictionaries where key is the block key, the bytes of sorted bit positions, and
+        value is a list of record IDs.
+    :param block_states: A list of PPRLIndex objects that hold configuration of the blocking job
+    :param threshold: int which decides a pair when number of 1 bits in bloom filter is large than or equal to threshold
+    :return: final_block_keys: set of block keys whose bits are all set in the blocking filter and which exist in at
+        least threshold many reversed indices
+    """
+    bf_len = int(block_states[0].blocking_config.get("bf-len", None))
 
-    # filter reversed_indices with block filter
+    # generate counting bloom filter: for each bit, the number of parties whose candidate bloom filter has it set
+    cbf_array = np.zeros(bf_len, dtype=np.int64)
     for reversed_index in reversed_indices:
-        has_matches = {bf_set: all(block_filter[i] for i in ast.literal_eval(bf_set)) for bf_set in reversed_index}
-        for bf_set in has_matches:
-            if not has_matches[bf_set]:
-                del reversed_index[bf_set]
+        _, _, positions = block_key_layout(reversed_index)
+        cbf_array += np.bincount(positions, minlength=bf_len) > 0
+    # compute blocking filter (and operation)
+    block_filter = cbf_array >= threshold
 
     # because of collisions in counting bloom filter, there are blocks only unique to one filtered index
     # only keep blocks that exist in at least threshold many reversed indices
-    keys = defaultdict(int)  # type: Dict[Set, int]
-    for reversed_index in reversed_indices:
-        for k in reversed_index:
-            keys[k] += 1
-    common_keys = [k for k in keys if keys[k] >= threshold]
-    clean_reversed_indices = []  # type: List[Dict[Set, List]]
-    for reversed_index in reversed_indices:
-        clean_reversed_indices.append(dict((k, reversed_index[k]) for k in common_keys if k in reversed_index))
-
-    return clean_reversed_indices
+    common_keys = select_common_block_keys(reversed_indices, threshold)
+
+    # the block filter doesn't depend on the party, so it only needs to be tested once for each common key
+    # keep blocks whose bits are all set in the block filter
+    block_keys, offsets, positions = block_key_layout(common_keys)
+    block_of_position = np.repeat(np.arange(len(block_keys)), np.diff(offsets))
+    num_unset = np.bincount(block_of_position[~block_filter[positions]], minlength=len(block_keys))
+    return {key for key, has_matches in zip(block_keys, (num_unset == 0).tolist()) if has_matches}
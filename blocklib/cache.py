@@ -0,0 +1,93 @@
+"""Bounded caches for values that are expensive to recompute."""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Union
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A bounded mapping which evicts the least recently used entry when it is full.
+
+    Hits, misses and evictions are counted so that the effectiveness of the cache can be monitored.
+    A ``maxsize`` of 0 disables caching. All methods are safe to call from multiple threads.
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        """Initialise an empty cache holding at most ``maxsize`` entries."""
+        self._check_maxsize(maxsize)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # type: OrderedDict[Hashable, Any]
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _check_maxsize(maxsize: int):
+        if not isinstance(maxsize, int) or maxsize < 0:
+            raise ValueError('Cache size must be a non-negative integer, got {}'.format(maxsize))
+
+    def get(self, key: Hashable, default: Any = None):
+        """Return the value cached for key and mark it as most recently used, or default if absent."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Cache value for key, evicting the least recently used entries if the cache is full."""
+        with self._lock:
+            if self.maxsize == 0:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]):
+        """Return the value cached for key, computing and caching it on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def resize(self, maxsize: int):
+        """Change the maximum number of entries, evicting the least recently used ones if necessary."""
+        self._check_maxsize(maxsize)
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self) -> Dict[str, Union[int, float]]:
+        """Return the counters, hit rate and current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+    def _evict(self) -> None:
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return key in self._data
@@ -1,5 +1,5 @@
 """Class that implement candidate block generations."""
-from typing import Dict, Sequence, Tuple, Type, List, Optional
+from typing import Dict, Sequence, Tuple, Type, List, Optional, Union
 from .configuration import get_config
 from .pprlindex import PPRLIndex
 from .pprlpsig import PPRLIndexPSignature
@@ -20,7 +20,8 @@ class CandidateBlockingResult:
     def __init__(self, blocks: Dict, state: PPRLIndex):
         """
         Initialise a blocking result object.
-        :param blocks: A dictionary where key is set of 1 bits in bloom filter and value is a list of record IDs
+        :param blocks: A dictionary where key is the block key, e.g. the bytes of the sorted 1 bits in the bloom filter
+            for P-Sig, and value is a list of record IDs
         :param state: A PPRLIndex state that contains configuration of blocking
         """
         self.blocks = blocks
@@ -28,7 +29,7 @@ class CandidateBlockingResult:
 
 
 def generate_candidate_blocks(data: Sequence[Tuple[str, ...]], signature_config: Dict, header: Optional[List[str]] = None,
-                              verbose: bool = False):
+                              verbose: bool = False, stats: Union[bool, str] = True):
     """
     :param data: list of tuples E.g. ('0', 'Kenneth Bain', '1964/06/17', 'M')
     :param signature_config:
@@ -38,6 +39,8 @@ def generate_candidate_blocks(data: Sequence[Tuple[str, ...]], signature_config:
     :param header: column names (optional)
         Program should throw exception if block features are string but header is None
     :param verbose: print additional information to std out.
+    :param stats: True to compute and print statistics of the blocks, False to skip them, or 'lazy' to compute them
+        when the stats of the state are first accessed.
 
     :return: A 2-tuple containing
         A list of "signatures" per record in data.
@@ -46,6 +49,8 @@ def generate_candidate_blocks(data: Sequence[Tuple[str, ...]], signature_config:
     """
     # validate config of blocking
     validate_signature_config(signature_config)
+    if stats not in (True, False, 'lazy'):
+        raise ValueError("stats must be True, False or 'lazy', got {}".format(stats))
 
     # extract algorithm and its config
     algorithm = signature_config.get('type', 'not specified')
@@ -64,7 +69,10 @@ def generate_candidate_blocks(data: Sequence[Tuple[str, ...]], signature_config:
     if algorithm in PPRLSTATES:
         state = PPRLSTATES[algorithm](config)
         reversed_index = state.build_reversed_index(data, verbose, header)
-        state.summarize_reversed_index(reversed_index)
+        if stats == 'lazy':
+            state.defer_summary(reversed_index)
+        elif stats:
+            state.summarize_reversed_index(reversed_index)
 
         # make candidate blocking result object
         candidate_block_obj = CandidateBlockingResult(reversed_index, state)
@@ -1,7 +1,46 @@
 """Class to implement privacy preserving encoding."""
 import hashlib
 import numpy as np
-from typing import List, Set
+from typing import Dict, List, Sequence
+
+from .cache import LRUCache
+
+# cache of bit positions keyed on (string, bf_len, num_hash_funct), resize with BIT_POSITION_CACHE.resize
+BIT_POSITION_CACHE = LRUCache(maxsize=2 ** 16)
+
+# P-Sig block keys are the bytes of sorted bit positions in this dtype, which doesn't depend on the platform
+BLOCK_KEY_DTYPE = np.dtype('<u4')
+
+# upper bound on the number of bits unpacked at once by generate_bloom_filters
+_UNPACKED_CHUNK_BITS = 2 ** 24
+
+
+def _hash_seeds(string: str, bf_len: int):
+    """Return the two base hash values of string used for double hashing."""
+    encoded = string.encode('utf-8')
+    int1 = int.from_bytes(hashlib.sha1(encoded).digest(), 'big') % bf_len
+    int2 = int.from_bytes(hashlib.md5(encoded).digest(), 'big') % bf_len
+    return int1, int2
+
+
+def bit_positions(string: str, bf_len: int, num_hash_funct: int):
+    """
+    Return the sorted indices of the bits flipped by hashing string, using BIT_POSITION_CACHE.
+
+    :param string: string: to be hashed
+    :param bf_len: int: length of bloom filter
+    :param num_hash_funct: int: number of hash functions
+    :return: positions: read-only np.uint32 array of distinct indices that have been flipped to 1
+    """
+    key = (string, bf_len, num_hash_funct)
+    positions = BIT_POSITION_CACHE.get(key)
+    if positions is None:
+        int1, int2 = _hash_seeds(string, bf_len)
+        # flip {num_hash_funct} times
+        positions = np.unique((int1 + np.arange(num_hash_funct, dtype=np.int64) * int2) % bf_len).astype(np.uint32)
+        positions.flags.writeable = False
+        BIT_POSITION_CACHE.put(key, positions)
+    return positions
 
 
 def flip_bloom_filter(string: str, bf_len: int, num_hash_funct: int):
@@ -13,45 +52,84 @@ def flip_bloom_filter(string: str, bf_len: int, num_hash_funct: int):
     :param num_hash_funct: int: number of hash functions
     :return: bfset: a set of integers - indices that have been flipped to 1
     """
-    # config for hashing
-    h1 = hashlib.sha1
-    h2 = hashlib.md5
+    return set(bit_positions(string, bf_len, num_hash_funct).tolist())
+
+
+def positions_to_block_key(positions) -> bytes:
+    """
+    Encode sorted, distinct bit positions as a P-Sig block key.
+
+    :param positions: sorted sequence or array of distinct bit positions
+    :return: block_key: the positions as little-endian uint32 bytes
+    """
+    return np.asarray(positions, dtype=BLOCK_KEY_DTYPE).tobytes()
 
-    sha_bytes = h1(string.encode('utf-8')).digest()
-    md5_bytes = h2(string.encode('utf-8')).digest()
-    int1 = int.from_bytes(sha_bytes, 'big') % bf_len
-    int2 = int.from_bytes(md5_bytes, 'big') % bf_len
 
-    # flip {num_hash_funct} times
-    bfset = set()
-    for i in range(num_hash_funct):
-        gi = (int1 + i * int2) % bf_len
-        bfset.add(gi)
+def block_key_to_positions(block_key: bytes) -> np.ndarray:
+    """
+    Decode a P-Sig block key into its bit positions.
 
-    return bfset
+    :param block_key: bytes as returned by positions_to_block_key
+    :return: positions: read-only array of the sorted bit positions
+    """
+    return np.frombuffer(block_key, dtype=BLOCK_KEY_DTYPE)
 
 
 def generate_bloom_filter(list_of_strs: List[str], bf_len: int, num_hash_funct: int):
     """
     Generate a bloom filter given list of strings.
 
-    :param return_cbf_index_sig_map:
     :param list_of_strs:
     :param bf_len:
     :param num_hash_funct:
-    :return: bloom_filter_vector if return_cbf_index_sig_map is False else (bloom_filter_vector, cbf_index_sig_map)
+    :return: bloom_filter_vector
     """
-    # go through each signature and generate bloom filter of it
-    # -- we only store the set of index that flipped to 1
-    candidate_bloom_filter = set()  # type: Set[int]
-
-    for signature in list_of_strs:
-        bfset = flip_bloom_filter(signature, bf_len, num_hash_funct)
-        # union indices that have been flipped 1 in candidate bf
-        candidate_bloom_filter = candidate_bloom_filter.union(bfset)
-
-    # massage the cbf into a numpy bool array from a set
+    # go through each signature and flip the bits it hashes to
     bloom_filter_vector = np.zeros(bf_len, dtype=bool)
-    bloom_filter_vector[list(candidate_bloom_filter)] = True
+    for signature in list_of_strs:
+        bloom_filter_vector[bit_positions(signature, bf_len, num_hash_funct)] = True
 
     return bloom_filter_vector
+
+
+def generate_bloom_filters(list_of_grams: Sequence[Sequence[str]], bf_len: int, num_hash_funct: int):
+    """
+    Generate bloom filters for a whole column of records at once.
+
+    Each distinct n-gram is hashed only once and the double hashing positions are computed
+    with numpy over all n-grams. The result is bit-identical to packing the output of
+    :func:`generate_bloom_filter` for each record with ``np.packbits``.
+
+    :param list_of_grams: a list of n-gram lists, one per record
+    :param bf_len: int: length of bloom filter
+    :param num_hash_funct: int: number of hash functions
+    :return: bloom_filters: np.uint8 array of shape (number of records, ceil(bf_len / 8)) with packed bits,
+        most significant bit first
+    """
+    num_records = len(list_of_grams)
+    num_bytes = (bf_len + 7) // 8
+
+    # give every distinct n-gram an integer id
+    gram_ids = {}  # type: Dict[str, int]
+    counts = np.fromiter((len(grams) for grams in list_of_grams), dtype=np.int64, count=num_records)
+    ids = np.fromiter((gram_ids.setdefault(gram, len(gram_ids)) for grams in list_of_grams for gram in grams),
+                      dtype=np.int64, count=int(counts.sum()))
+
+    # double hashing of each distinct n-gram: g_i = (h1 + i * h2) % bf_len
+    seeds = np.array([_hash_seeds(gram, bf_len) for gram in gram_ids], dtype=np.int64).reshape(-1, 2)
+    h1, h2 = seeds[:, 0], seeds[:, 1]
+    positions = (h1[:, None] + np.arange(num_hash_funct, dtype=np.int64)[None, :] * h2[:, None]) % bf_len
+
+    bloom_filters = np.zeros((num_records, num_bytes), dtype=np.uint8)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    # flip bits chunk by chunk to bound the size of the unpacked bit matrix
+    chunk_size = max(1, _UNPACKED_CHUNK_BITS // bf_len)
+    for start in range(0, num_records, chunk_size):
+        stop = min(start + chunk_size, num_records)
+        rows = np.repeat(np.arange(stop - start), counts[start:stop])
+        chunk_positions = positions[ids[offsets[start]:offsets[stop]]]
+        bits = np.zeros((stop - start, num_bytes * 8), dtype=bool)
+        bits[rows[:, None], chunk_positions] = True
+        bloom_filters[start:stop] = np.packbits(bits, axis=1)
+
+    return bloom_filters
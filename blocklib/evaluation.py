@@ -1,46 +1,64 @@
 """Module to evaluate blocking when ground truth is available."""
+from collections import defaultdict
+import functools
+import itertools
+import math
+import operator
+import random
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+import numpy as np
 from tqdm import tqdm
 
+from .pairs import DEFAULT_MAX_MEMORY, iter_candidate_pairs
 
-def assess_blocks_2party(filtered_reverse_indices, data):
+
+def entity_codes(data: Sequence[Sequence[Any]]):
+    """Map the entity ids of all data providers to dense integers shared by all data providers.
+
+    :param data: a list of lists of entity_ids, one per data provider
+    :return: list of int64 arrays, the entity code of every record of each data provider
+    """
+    code_of_entity = {}  # type: Dict[Any, int]
+    return [np.fromiter((code_of_entity.setdefault(entity, len(code_of_entity)) for entity in entities),
+                        dtype=np.int64, count=len(entities))
+            for entities in data]
+
+
+def assess_blocks_2party(filtered_reverse_indices, data, max_memory: int = DEFAULT_MAX_MEMORY):
     """Assess pair completeness and reduction ratio of blocking result.
 
+    Candidate pairs are counted as distinct pairs of entities. They are enumerated as pairs of dense entity codes
+    and deduplicated in chunks, using about max_memory bytes.
+
     :ivar filtered_reverse_indices for each data provider, a dict containing the mapping from block id to corresponding record ids.
     :ivar data: a list of lists of entity_ids for 2 data providers
+    :ivar max_memory: approximate number of bytes used to deduplicate the candidate pairs
     """
     # currently just support for two party
     dp1_signature, dp2_signature = filtered_reverse_indices
     dp1_data, dp2_data = data
 
-    cand_pairs = {}  # key is record id of data provider1 and value is list of record ids from data provider 2
-    num_block_true_matches = 0
-    num_block_false_matches = 0
-
-    keys = set(dp1_signature.keys()).intersection(dp2_signature.keys())
-    for key in tqdm(keys, desc='assessing blocks', total=len(keys), unit='key'):
-        dp1_recs = dp1_signature.get(key, None)
-        dp2_recs = dp2_signature.get(key, None)
-        if dp1_recs is None or dp2_recs is None:
-            continue
-        for d1 in dp1_recs:
-            d1_entity = dp1_data[d1]
-            d1_cache = cand_pairs.get(d1_entity, set())
-            for d2 in dp2_recs:
-                d2_entity = dp2_data[d2]
-                if d2_entity not in d1_cache:
-                    d1_cache.add(d2_entity)
-                    if d2_entity == d1_entity:
-                        num_block_true_matches += 1
-                    else:
-                        num_block_false_matches += 1
-            cand_pairs[d1_entity] = d1_cache
-
-    num_cand_rec_pairs = num_block_true_matches + num_block_false_matches
     total_rec = len(dp1_data) * len(dp2_data)
-    
     if total_rec == 0:
         raise ValueError('There are not records in the provided data. Therefore we cannot assess the blocking result.')
 
+    dp1_codes, dp2_codes = entity_codes([dp1_data, dp2_data])
+    # replace the record ids of the shared blocks by entity codes
+    dp1_blocks = {}  # type: Dict[Any, np.ndarray]
+    dp2_blocks = {}  # type: Dict[Any, np.ndarray]
+    for key, dp1_recs in dp1_signature.items():
+        dp2_recs = dp2_signature.get(key, ())
+        if len(dp1_recs) and len(dp2_recs):
+            dp1_blocks[key] = dp1_codes[np.asarray(dp1_recs, dtype=np.int64)]
+            dp2_blocks[key] = dp2_codes[np.asarray(dp2_recs, dtype=np.int64)]
+
+    num_cand_rec_pairs = 0
+    num_block_true_matches = 0
+    entity_pairs = iter_candidate_pairs([dp1_blocks, dp2_blocks], max_memory=max_memory)
+    for dp1_entities, dp2_entities in tqdm(entity_pairs, desc='assessing blocks', unit='chunk'):
+        num_cand_rec_pairs += len(dp1_entities)
+        num_block_true_matches += int(np.count_nonzero(dp1_entities == dp2_entities))
+
     entity1 = set(dp1_data)
     entity2 = set(dp2_data)
     num_all_true_matches = len(entity1.intersection(entity2))
@@ -49,7 +67,202 @@ def assess_blocks_2party(filtered_reverse_indices, data):
     rr = 1.0 - float(num_cand_rec_pairs) / total_rec
     if num_all_true_matches == 0:
         print("Pair completeness is zero, because there are no true matches in the provided data.")
-        pc = 0
+        pc = 0  # type: float
     else:
         pc = float(num_block_true_matches) / num_all_true_matches
     return rr, pc
+
+
+def assess_blocks_multiparty(filtered_reverse_indices, data, K: int = 2,
+                             max_memory: int = DEFAULT_MAX_MEMORY) -> Dict[str, Dict[Tuple[int, ...], Dict[str, float]]]:
+    """Assess pair completeness and reduction ratio of blocking result of more than 2 data providers.
+
+    The blocks of all data providers are visited once. For every pair of data providers, rr and pc are the ones
+    assess_blocks_2party reports for their blocks. For every subset of K data providers, pc is the share of
+    entities common to all of them with a record of every data provider in one block. The rr of a subset counts a
+    tuple of records once for every block it shares, so it is a lower bound of the reduction ratio.
+    pc is zero if there are no true matches.
+
+    :ivar filtered_reverse_indices for each data provider, a dict containing the mapping from block id to corresponding record ids.
+    :ivar data: a list of lists of entity_ids, one per data provider
+    :ivar K: size of the subsets of data providers
+    :ivar max_memory: approximate number of bytes used to deduplicate the candidate pairs of a pair of data providers
+    :return: dict with 'pairs' mapping each pair of data provider indices and 'subsets' mapping each K-subset of data
+        provider indices to a dict with rr and pc
+    """
+    num_parties = len(filtered_reverse_indices)
+    if len(data) != num_parties:
+        raise ValueError('Expected entity ids of {} data providers, got {}'.format(num_parties, len(data)))
+    if not 2 <= K <= num_parties:
+        raise ValueError('K must be between 2 and the number of data providers, got {}'.format(K))
+    if any(len(entities) == 0 for entities in data):
+        raise ValueError('There are not records in the provided data. Therefore we cannot assess the blocking result.')
+
+    codes = entity_codes(data)
+    party_pairs = list(itertools.combinations(range(num_parties), 2))
+    subsets = list(itertools.combinations(range(num_parties), K))
+    # entity codes of the blocks shared by each pair of data providers
+    pair_blocks = {pair: ({}, {}) for pair in party_pairs}  # type: Dict[Tuple[int, ...], Tuple[Dict, Dict]]
+    subset_found = {subset: set() for subset in subsets}  # type: Dict[Tuple[int, ...], Set[int]]
+    subset_block_pairs = dict.fromkeys(subsets, 0)
+
+    for key in dict.fromkeys(itertools.chain.from_iterable(filtered_reverse_indices)):
+        block = {}  # type: Dict[int, np.ndarray]
+        for party, reversed_index in enumerate(filtered_reverse_indices):
+            recs = reversed_index.get(key, ())
+            if len(recs):
+                block[party] = codes[party][np.asarray(recs, dtype=np.int64)]
+        if len(block) < 2:
+            continue
+        for i, j in itertools.combinations(sorted(block), 2):
+            pair_blocks[(i, j)][0][key] = block[i]
+            pair_blocks[(i, j)][1][key] = block[j]
+        for subset in itertools.combinations(sorted(block), K):
+            subset_block_pairs[subset] += functools.reduce(operator.mul, (len(block[party]) for party in subset))
+            subset_found[subset].update(functools.reduce(np.intersect1d, [block[party] for party in subset]).tolist())
+
+    entity_sets = [set(party_codes.tolist()) for party_codes in codes]
+    pair_results = {}  # type: Dict[Tuple[int, ...], Dict[str, float]]
+    for i, j in party_pairs:
+        num_cand_rec_pairs = 0
+        num_block_true_matches = 0
+        for entities_i, entities_j in iter_candidate_pairs(pair_blocks[(i, j)], max_memory=max_memory):
+            num_cand_rec_pairs += len(entities_i)
+            num_block_true_matches += int(np.count_nonzero(entities_i == entities_j))
+        num_all_true_matches = len(entity_sets[i] & entity_sets[j])
+        pair_results[(i, j)] = {
+            'rr': 1.0 - float(num_cand_rec_pairs) / (len(data[i]) * len(data[j])),
+            'pc': float(num_block_true_matches) / num_all_true_matches if num_all_true_matches else 0.0,
+        }
+
+    subset_results = {}  # type: Dict[Tuple[int, ...], Dict[str, float]]
+    for subset in subsets:
+        num_all_true_matches = len(set.intersection(*[entity_sets[party] for party in subset]))
+        num_all_tuples = functools.reduce(operator.mul, (len(data[party]) for party in subset))
+        subset_results[subset] = {
+            'rr': 1.0 - float(subset_block_pairs[subset]) / num_all_tuples,
+            'pc': float(len(subset_found[subset])) / num_all_true_matches if num_all_true_matches else 0.0,
+        }
+    return {'pairs': pair_results, 'subsets': subset_results}
+
+
+def estimate_blocks_2party(filtered_reverse_indices, data, num_samples: int = 10000, confidence: float = 0.95,
+                           random_state: Optional[int] = None) -> Dict[str, Any]:
+    """Estimate pair completeness and reduction ratio of blocking result by sampling.
+
+    Pair completeness is estimated on a sample of the entities of both data providers, counting an entity as found
+    if any of its records share a block. Reduction ratio is estimated on a sample of record pairs, counting a pair
+    as candidate if the records share a block. It equals the reduction ratio of assess_blocks_2party if the entity
+    ids of each data provider are unique. Confidence intervals are Wilson score intervals.
+
+    :ivar filtered_reverse_indices for each data provider, a dict containing the mapping from block id to corresponding record ids.
+    :ivar data: a list of lists of entity_ids for 2 data providers
+    :ivar num_samples: number of sampled record pairs and of sampled entities
+    :ivar confidence: confidence level of the intervals
+    :ivar random_state: seed of the sampling
+    :return: dict with the estimated rr and pc, their intervals rr_interval and pc_interval as (lower, upper)
+        and the number of samples num_pair_samples and num_match_samples
+    """
+    dp1_signature, dp2_signature = filtered_reverse_indices
+    dp1_data, dp2_data = data
+    if len(dp1_data) * len(dp2_data) == 0:
+        raise ValueError('There are not records in the provided data. Therefore we cannot assess the blocking result.')
+    if num_samples < 1:
+        raise ValueError('Number of samples must be positive, got {}'.format(num_samples))
+    rng = random.Random(random_state)
+    z = _normal_quantile(0.5 + confidence / 2)
+
+    # reduction ratio is estimated on random record pairs, pair completeness on random true matches
+    pair_samples = [(rng.randrange(len(dp1_data)), rng.randrange(len(dp2_data))) for _ in range(num_samples)]
+    entity2 = set(dp2_data)
+    common_entities = [entity for entity in dict.fromkeys(dp1_data) if entity in entity2]
+    if not common_entities:
+        print("Pair completeness is zero, because there are no true matches in the provided data.")
+    match_samples = set(rng.sample(common_entities, min(num_samples, len(common_entities))))
+    dp1_records = _entity_records(dp1_data, match_samples)
+    dp2_records = _entity_records(dp2_data, match_samples)
+
+    # look up the blocks of the records of both samples in one pass over the blocks of each data provider
+    dp1_blocks = sampled_record_blocks(dp1_signature, {r1 for r1, _ in pair_samples}.union(
+        itertools.chain.from_iterable(dp1_records.values())))
+    dp2_blocks = sampled_record_blocks(dp2_signature, {r2 for _, r2 in pair_samples}.union(
+        itertools.chain.from_iterable(dp2_records.values())))
+
+    # reduction ratio: the share of random record pairs that don't share a block
+    num_cand_pairs = sum(1 for r1, r2 in pair_samples if not dp1_blocks[r1].isdisjoint(dp2_blocks[r2]))
+    cand_lower, cand_upper = wilson_interval(num_cand_pairs, num_samples, z)
+
+    # pair completeness: the share of true matches whose records share a block
+    num_found = sum(1 for entity in match_samples
+                    if any(not dp1_blocks[r1].isdisjoint(dp2_blocks[r2])
+                           for r1 in dp1_records[entity] for r2 in dp2_records[entity]))
+    if len(match_samples) == len(common_entities):
+        # all true matches are sampled, so pair completeness is exact
+        pc = float(num_found) / len(common_entities) if common_entities else 0.0
+        pc_interval = (pc, pc)
+    else:
+        pc = float(num_found) / len(match_samples)
+        pc_interval = wilson_interval(num_found, len(match_samples), z)
+
+    return {
+        'rr': 1.0 - float(num_cand_pairs) / num_samples,
+        'rr_interval': (1.0 - cand_upper, 1.0 - cand_lower),
+        'pc': pc,
+        'pc_interval': pc_interval,
+        'num_pair_samples': num_samples,
+        'num_match_samples': len(match_samples),
+    }
+
+
+def sampled_record_blocks(reversed_index: Dict[Any, Sequence[int]], records: Set[int]):
+    """Return the keys of the blocks each of the given records is in.
+
+    :param reversed_index: dict mapping block keys to record ids
+    :param records: record ids to look up
+    :return: dict mapping every record id to the set of keys of its blocks
+    """
+    record_blocks = {rec: set() for rec in records}  # type: Dict[int, Set[Any]]
+    if not records:
+        return record_blocks
+    block_keys = list(reversed_index)
+    lengths = np.fromiter((len(recs) for recs in reversed_index.values()), dtype=np.int64, count=len(block_keys))
+    recs = np.fromiter(itertools.chain.from_iterable(reversed_index.values()), dtype=np.int64,
+                       count=int(lengths.sum()))
+    block_of_rec = np.repeat(np.arange(len(block_keys)), lengths)
+    found = np.isin(recs, np.fromiter(records, dtype=np.int64, count=len(records)))
+    for rec, block in zip(recs[found].tolist(), block_of_rec[found].tolist()):
+        record_blocks[rec].add(block_keys[block])
+    return record_blocks
+
+
+def _entity_records(entities: Sequence[Any], sampled_entities: Set[Any]):
+    records = defaultdict(list)  # type: Dict[Any, List[int]]
+    for rec, entity in enumerate(entities):
+        if entity in sampled_entities:
+            records[entity].append(rec)
+    return records
+
+
+def wilson_interval(successes: int, trials: int, z: float):
+    """Return the Wilson score interval (lower, upper) of a binomial proportion."""
+    if trials == 0:
+        return 0.0, 1.0
+    p = float(successes) / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def _normal_quantile(p: float):
+    # invert the standard normal cumulative distribution function by bisection
+    if not 0.5 <= p < 1:
+        raise ValueError('Confidence must be in [0, 1), got {}'.format(2 * p - 1))
+    lower, upper = 0.0, 40.0
+    for _ in range(100):
+        middle = (lower + upper) / 2
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < p:
+            lower = middle
+        else:
+            upper = middle
+    return (lower + upper) / 2
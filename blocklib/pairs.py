@@ -0,0 +1,125 @@
+"""Module to enumerate the unique candidate record pairs of the final blocks."""
+from typing import Any, Dict, Iterator, Sequence, Tuple
+import numpy as np
+
+DEFAULT_PAIRS_CHUNK_SIZE = 2**16
+DEFAULT_MAX_MEMORY = 2**28
+
+# a pair is encoded as one int64 code; sorting the codes to remove duplicates needs about two more copies of them
+_BYTES_PER_PAIR = 3 * np.dtype(np.int64).itemsize
+
+
+def block_record_arrays(filtered_reverse_indices: Sequence[Dict]):
+    """
+    Collect the record IDs of the blocks shared by two data providers as int64 arrays.
+
+    :param filtered_reverse_indices: for each of the 2 data providers, a dict mapping block keys to record IDs
+    :return: list of (record IDs of first party, record IDs of second party) array tuples, one per shared block
+    """
+    if len(filtered_reverse_indices) != 2:
+        raise ValueError('Candidate pairs are enumerated between 2 data providers, got {}'.format(
+            len(filtered_reverse_indices)))
+    reversed_index_a, reversed_index_b = filtered_reverse_indices
+    blocks = []
+    for block_key, recs_a in reversed_index_a.items():
+        recs_b = reversed_index_b.get(block_key, ())
+        if len(recs_a) == 0 or len(recs_b) == 0:
+            continue
+        blocks.append((_as_record_array(recs_a), _as_record_array(recs_b)))
+    return blocks
+
+
+def _as_record_array(record_ids: Sequence[Any]) -> np.ndarray:
+    records = np.asarray(record_ids)
+    if records.dtype.kind not in 'iu':
+        raise ValueError('Candidate pairs require integer record IDs, got {}'.format(records.dtype))
+    if records.min() < 0:
+        raise ValueError('Candidate pairs require non-negative record IDs')
+    return records.astype(np.int64, copy=False)
+
+
+def iter_candidate_pairs(filtered_reverse_indices: Sequence[Dict],
+                         chunk_size: int = DEFAULT_PAIRS_CHUNK_SIZE,
+                         max_memory: int = DEFAULT_MAX_MEMORY) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Enumerate the unique candidate record pairs of 2 data providers in chunks.
+
+    A pair of records sharing several blocks is only returned once. Pairs are encoded as int64 codes and
+    deduplicated by sorting. If all codes don't fit in max_memory, the codes are split into partitions by a hash
+    of the code, which are deduplicated one after the other. The codes of each block are generated in slices that
+    fit in the budget, so a single large block doesn't exceed it either. Pairs are ordered by partition and then by
+    (rec_a, rec_b).
+
+    :param filtered_reverse_indices: for each of the 2 data providers, a dict mapping block keys to the
+        non-negative integer record IDs in the block, e.g. the output of generate_blocks
+    :param chunk_size: number of pairs per chunk. Only the last chunk may be shorter.
+    :param max_memory: approximate number of bytes used to deduplicate the pairs
+    :return: generator of (rec_a, rec_b) tuples of int64 arrays of equal length
+    """
+    if chunk_size < 1:
+        raise ValueError('Chunk size must be positive, got {}'.format(chunk_size))
+    if max_memory < _BYTES_PER_PAIR:
+        raise ValueError('Memory cap must be at least {} bytes, got {}'.format(_BYTES_PER_PAIR, max_memory))
+
+    blocks = block_record_arrays(filtered_reverse_indices)
+    if not blocks:
+        return
+    stride = max(int(recs_b.max()) for _, recs_b in blocks) + 1
+    max_rec_a = max(int(recs_a.max()) for recs_a, _ in blocks)
+    if max_rec_a >= np.iinfo(np.int64).max // stride:
+        raise ValueError('Record IDs are too large to encode candidate pairs as int64')
+
+    num_block_pairs = sum(len(recs_a) * len(recs_b) for recs_a, recs_b in blocks)
+    num_partitions = -(-num_block_pairs * _BYTES_PER_PAIR // max_memory)
+    # half of the budget holds the codes of a slice of a block, the other half the codes of the partition
+    budget_pairs = max(1, max_memory // _BYTES_PER_PAIR // 2)
+
+    pending = np.empty(0, dtype=np.int64)
+    for partition in range(num_partitions):
+        partition_codes = np.empty(0, dtype=np.int64)
+        for codes in _block_pair_codes(blocks, stride, budget_pairs):
+            if num_partitions > 1:
+                codes = codes[_code_partition(codes, num_partitions) == partition]
+            partition_codes = np.concatenate([partition_codes, codes])
+            if len(partition_codes) > budget_pairs:
+                partition_codes = np.unique(partition_codes)
+        pending = np.concatenate([pending, np.unique(partition_codes)])
+        num_full = len(pending) // chunk_size * chunk_size
+        for start in range(0, num_full, chunk_size):
+            yield np.divmod(pending[start:start + chunk_size], stride)
+        pending = pending[num_full:]
+    if len(pending):
+        yield np.divmod(pending, stride)
+
+
+def _block_pair_codes(blocks: Sequence[Tuple[np.ndarray, np.ndarray]], stride: int,
+                      budget_pairs: int) -> Iterator[np.ndarray]:
+    """Generate the pair codes of all blocks in slices of at most budget_pairs codes."""
+    for recs_a, recs_b in blocks:
+        slice_b = min(len(recs_b), budget_pairs)
+        slice_a = max(1, budget_pairs // slice_b)
+        for start_b in range(0, len(recs_b), slice_b):
+            part_b = recs_b[start_b:start_b + slice_b]
+            for start_a in range(0, len(recs_a), slice_a):
+                yield (recs_a[start_a:start_a + slice_a, np.newaxis] * stride + part_b).ravel()
+
+
+def _code_partition(codes: np.ndarray, num_partitions: int) -> np.ndarray:
+    # mix the bits of the codes by multiplicative hashing, so that skewed record IDs spread over all partitions
+    hashed = codes.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return (hashed >> np.uint64(32)) % np.uint64(num_partitions)
+
+
+def candidate_pairs(filtered_reverse_indices: Sequence[Dict],
+                    max_memory: int = DEFAULT_MAX_MEMORY) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return all unique candidate record pairs of 2 data providers.
+
+    :param filtered_reverse_indices: for each of the 2 data providers, a dict mapping block keys to record IDs
+    :param max_memory: approximate number of bytes used to deduplicate the pairs
+    :return: tuple of int64 arrays (rec_a, rec_b)
+    """
+    chunks = list(iter_candidate_pairs(filtered_reverse_indices, max_memory=max_memory))
+    if not chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate([a for a, _ in chunks]), np.concatenate([b for _, b in chunks])
@@ -1,7 +1,7 @@
 import random
-from typing import Any, Dict, List, Sequence, Optional
+from typing import Any, Dict, List, Sequence, Optional, Set
 from blocklib.configuration import get_config
-from blocklib.stats import reversed_index_stats
+from blocklib.stats import summarize_blocks
 from blocklib.utils import check_header
 
 
@@ -13,7 +13,8 @@ class PPRLIndex:
         self.rec_dict = None
         self.ent_id_col = None
         self.rec_id_col = None
-        self.stats = {}  # type: Dict[str, Any]
+        self._deferred_reversed_index = None  # type: Optional[Dict]
+        self.stats = {}
 
     def get_feature_to_index_map(self, data: Sequence[Sequence], header: Optional[List[str]] = None):
         """Return feature name to feature index mapping if there is a header and feature is of type string."""
@@ -50,21 +51,51 @@ class PPRLIndex:
         """
         raise NotImplementedError("Derived class needs to implement")
 
+    def split_blocks(self, reversed_index: Dict, block_keys: Set, data: Any, level: int,
+                     header: Optional[List[str]] = None):
+        """Split blocks of the reversed index into sub-blocks.
+
+           :param reversed_index: dict mapping block keys to record IDs, as returned by build_reversed_index
+           :param block_keys: keys of the blocks to split
+           :param data: the data the reversed index was built from
+           :param level: number of times the blocks have been split before
+           :param header: file header, optional
+           :return: reversed index where each block in block_keys is replaced by its sub-blocks
+
+           The sub-block keys must only depend on the configuration, level and record, so that the sub-blocks of
+           all data providers line up. See derived classes for actual implementations.
+        """
+        raise NotImplementedError("Derived class needs to implement")
+
+    @staticmethod
+    def get_record_to_row_map(data: Sequence[Sequence], record_id_col: Optional[int]):
+        """Return a mapping from record ID to row of data, or None if the record IDs are the row numbers."""
+        if record_id_col is None:
+            return None
+        return {dtuple[record_id_col]: row for row, dtuple in enumerate(data)}
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Statistics of the reversed index, computed on first access if the summary was deferred."""
+        if self._deferred_reversed_index is not None:
+            self._stats = summarize_blocks(self._deferred_reversed_index)
+            self._deferred_reversed_index = None
+        return self._stats
+
+    @stats.setter
+    def stats(self, value: Dict[str, Any]):
+        self._stats = value
+        self._deferred_reversed_index = None
+
+    def defer_summary(self, reversed_index: Dict):
+        """Compute the statistics of the reversed index only when stats is first accessed."""
+        self._deferred_reversed_index = reversed_index
+
     def summarize_reversed_index(self, reversed_index: Dict):
         """Summarize statistics of reverted index / blocks."""
         assert len(reversed_index) > 0
-        # statistics of block
-        self.stats = reversed_index_stats(reversed_index)
-        # find how many blocks each entity / record is a member of
-        rec_to_block = {}  # type: Dict[Any, List[Any]]
-        for block_id, block in reversed_index.items():
-            for rec in block:
-                if rec in rec_to_block:
-                    rec_to_block[rec].append(block_id)
-                else:
-                    rec_to_block[rec] = [block_id]
-        num_of_blocks_per_rec = [len(x) for x in rec_to_block.values()]
-        self.stats['num_of_blocks_per_rec'] = num_of_blocks_per_rec
+        # statistics of block sizes and the number of blocks each entity / record is a member of
+        self.stats = summarize_blocks(reversed_index)
 
         print('Statistics for the generated blocks:')
         print('\tNumber of Blocks:   {}'.format(self.stats['num_of_blocks']))
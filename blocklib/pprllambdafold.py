@@ -1,11 +1,97 @@
+import os
 import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from collections import defaultdict
-from typing import Dict, Sequence, Any, List, Optional
+from typing import Dict, Iterable, Sequence, Any, List, Optional, Set, Tuple
 from blocklib.configuration import get_config
 from .pprlindex import PPRLIndex
-from .encoding import generate_bloom_filter
-from .utils import deserialize_filters, check_header
+from .encoding import generate_bloom_filter, generate_bloom_filters
+from .utils import deserialize_filters_to_array, load_clk_file
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None  # type: ignore
+
+# block keys are packed into unsigned 64 bit integers
+MAX_K = 64
+# number of CLKs read at once when computing block keys
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+
+def lambda_table_keys(clks: np.ndarray, indices: Sequence[int]):
+    """Compute the block key of every CLK for one Lambda table.
+
+    :param clks: np.uint8 array of shape (number of records, bytes per CLK) with packed bits, most significant bit first
+    :param indices: the K sampled bit positions of this table
+    :return: keys: np.uint64 array where the bits of each key are the sampled bits, the first sampled bit being the
+        most significant one
+    """
+    bit_indices = np.asarray(indices, dtype=np.int64)
+    # gather the K sampled bits of all records at once
+    bits = (clks[:, bit_indices >> 3] >> (7 - (bit_indices & 7)).astype(np.uint8)) & 1
+    keys = np.zeros(len(clks), dtype=np.uint64)
+    for column in bits.T:
+        keys = (keys << np.uint64(1)) | column
+    return keys
+
+
+def lambda_fold_keys(clks: np.ndarray, table_indices: Sequence[Sequence[int]], chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Compute the block keys of every CLK for all Lambda tables in one pass over the CLKs.
+
+    :param clks: np.uint8 array of packed CLKs, may be a memory mapped file
+    :param table_indices: the K sampled bit positions of each table
+    :param chunk_size: number of CLKs processed at once
+    :return: keys: np.uint64 array of shape (number of tables, number of records)
+    """
+    keys = np.empty((len(table_indices), len(clks)), dtype=np.uint64)
+    for start in range(0, len(clks), chunk_size):
+        chunk = np.asarray(clks[start: start + chunk_size])
+        for i, indices in enumerate(table_indices):
+            keys[i, start: start + len(chunk)] = lambda_table_keys(chunk, indices)
+    return keys
+
+
+def group_block_keys(keys: np.ndarray):
+    """Group record positions by block key.
+
+    :param keys: block key of every record
+    :return: A 3-tuple containing
+        the distinct keys in order of their first occurrence
+        positions of the records grouped by key in that order, ascending within each group
+        offsets of the groups, such that group j is members[offsets[j]:offsets[j + 1]]
+    """
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    by_first_occurrence = np.argsort(first)
+    rank = np.empty_like(by_first_occurrence)
+    rank[by_first_occurrence] = np.arange(len(by_first_occurrence))
+    labels = rank[inverse.ravel()]
+    members = np.argsort(labels, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(unique_keys)))))
+    return unique_keys[by_first_occurrence], members, offsets
+
+
+def _lambda_table_worker(source: Tuple[str, Any, Any], indices: Sequence[int], chunk_size: int):
+    """Group the CLKs for one Lambda table. Runs in a worker process.
+
+    The CLKs are either held in shared memory, source is ('shm', name, shape), or in a binary CLK file,
+    source is ('file', path, bytes per CLK).
+    """
+    kind, location, layout = source
+    if kind == 'file':
+        clks = load_clk_file(location, layout)
+        return group_block_keys(lambda_fold_keys(clks, [indices], chunk_size)[0])
+
+    shm = shared_memory.SharedMemory(name=location)
+    try:
+        clks = np.ndarray(layout, dtype=np.uint8, buffer=shm.buf)
+        groups = group_block_keys(lambda_fold_keys(clks, [indices], chunk_size)[0])
+        # release the view before closing the shared memory block
+        del clks
+    finally:
+        shm.close()
+    return groups
 
 
 class PPRLIndexLambdaFold(PPRLIndex):
@@ -34,9 +120,19 @@ class PPRLIndexLambdaFold(PPRLIndex):
         self.num_hash_function = int(get_config(config, "num-hash-funcs"))
         # K: number of base Hamming LSH hashing functions
         self.K = int(get_config(config, "K"))
+        if self.K > MAX_K:
+            raise ValueError('K must not exceed {} but is {}'.format(MAX_K, self.K))
         self.input_clks = get_config(config, 'input-clks')
         self.random_state = get_config(config, "random_state")
         self.record_id_col = config.get("record-id-col", None)
+        # number of processes building the Lambda tables
+        self.workers = int(config.get("workers", 1))
+        # number of CLKs read at once when computing block keys
+        self.chunk_size = int(config.get("chunk-size", DEFAULT_CHUNK_SIZE))
+        # number of additional sampled bits used to split an oversized block
+        self.split_bits = int(config.get("split-bits", self.K))
+        if self.split_bits > MAX_K:
+            raise ValueError('split-bits must not exceed {} but is {}'.format(MAX_K, self.split_bits))
 
     def __record_to_bf__(self, record: Sequence, blocking_features_index: List[int]):
         """Convert a record to list of bigrams and then map to a bloom filter."""
@@ -47,40 +143,157 @@ class PPRLIndexLambdaFold(PPRLIndex):
         bloom_filter = generate_bloom_filter(grams, self.bf_len, self.num_hash_function)
         return bloom_filter
 
-    def build_reversed_index(self, data: Sequence[Any], verbose: bool = False, header: Optional[List[str]] = None):
+    def __records_to_bfs__(self, data: Sequence[Sequence], blocking_features_index: List[int]):
+        """Convert all records to bigrams and map them to a packed bloom filter matrix in one batch."""
+        ngram = 2
+        strings = (''.join([record[i] for i in blocking_features_index]) for record in data)
+        grams = [[s[i: i + ngram] for i in range(len(s) - ngram + 1)] for s in strings]
+        return generate_bloom_filters(grams, self.bf_len, self.num_hash_function)
+
+    def __load_clks__(self, data: Any, header: Optional[List[str]] = None):
+        """Return the packed CLK matrix of data, its length in bits and the path of the CLK file if data is one."""
+        if self.input_clks and isinstance(data, (str, os.PathLike)):
+            if self.record_id_col is not None:
+                raise ValueError('record-id-col is not supported when reading CLKs from a file')
+            clk_file = os.fspath(data)
+            clks = load_clk_file(clk_file, (self.bf_len + 7) // 8)
+            return clks, clks.shape[1] * 8, clk_file
+        if self.input_clks:
+            clks = deserialize_filters_to_array(data)
+            return clks, clks.shape[1] * 8, None
+        feature_to_index = self.get_feature_to_index_map(data, header)
+        self.set_blocking_features_index(self.blocking_features, feature_to_index)
+        return self.__records_to_bfs__(data, self.blocking_features_index), self.bf_len, None
+
+    def __load_clk_rows__(self, data: Any, rows: np.ndarray, header: Optional[List[str]] = None):
+        """Return the packed CLK matrix of the given rows of data only, and its length in bits."""
+        if self.input_clks and isinstance(data, (str, os.PathLike)):
+            # the memory mapped file only reads the requested rows
+            clks, bf_len, _ = self.__load_clks__(data, header)
+            return np.asarray(clks[rows]), bf_len
+        row_list = rows.tolist()
+        if self.input_clks:
+            clks = deserialize_filters_to_array([data[row] for row in row_list])
+            return clks, clks.shape[1] * 8
+        feature_to_index = self.get_feature_to_index_map(data, header)
+        self.set_blocking_features_index(self.blocking_features, feature_to_index)
+        return self.__records_to_bfs__([data[row] for row in row_list], self.blocking_features_index), self.bf_len
+
+    def build_reversed_index(self, data: Any, verbose: bool = False, header: Optional[List[str]] = None):
         """Build inverted index for PPRL Lambda-fold blocking method.
 
-        :param data: list of lists
+        :param data: list of lists, or if input-clks is true either a list of equal length CLKs given as base64
+            strings or raw bytes, or the path of a binary CLK file (a ``.npy`` file or raw bytes) which is memory
+            mapped and read in chunks
         :param verbose: ignored
-        :return:
+        :return: invert_index: dictionary where key is a tuple of the table index and the integer formed by the K
+            sampled bits and value is a list of record IDs
         """
-        feature_to_index = self.get_feature_to_index_map(data, header)
-        self.set_blocking_features_index(self.blocking_features, feature_to_index)
+        clks, bf_len, clk_file = self.__load_clks__(data, header)
 
         # create record index lists
         if self.record_id_col is None:
-            record_ids = list(range(len(data)))
+            record_ids = np.arange(len(clks))
         else:
-            record_ids = [x[self.record_id_col] for x in data]
+            record_ids = np.empty(len(data), dtype=object)
+            record_ids[:] = [x[self.record_id_col] for x in data]
 
         random.seed(self.random_state)
 
-        if self.input_clks:
-            clks = deserialize_filters(data)
+        # sample K indices from [0, bf-len] for each of the Lambda tables
+        table_indices = [random.sample(range(bf_len), self.K) for _ in range(self.mylambda)]
+        parallel = self.workers > 1 and self.mylambda > 1
+        if parallel and clk_file is not None:
+            tables = self.__parallel_lambda_tables__(('file', clk_file, clks.shape[1]), table_indices)  # type: Iterable
+        elif parallel and shared_memory is not None:
+            tables = self.__parallel_shared_lambda_tables__(clks, table_indices)
+        elif parallel:
+            # shared memory requires Python 3.8+, the workers read a temporary CLK file instead
+            tables = self.__parallel_file_lambda_tables__(clks, table_indices)
         else:
-            clks = [self.__record_to_bf__(rec, self.blocking_features_index) for rec in data]
-        bf_len = len(clks[0])
-
-        # build Lambda fold tables and add to the invert index
-        invert_index = {}  # type: Dict[Any, List[Any]]
-        for i in range(self.mylambda):
-            lambda_table = defaultdict(list)  # type: Dict[Any, Any]
-            # sample K indices from [0, bf-len]
-            indices = random.sample(range(bf_len), self.K)
-            for rec_id, clk in zip(record_ids, clks):
-                block_key = ''.join(['1' if clk[ind] else '0' for ind in indices])
-                lambda_table['{}{}'.format(i, block_key)].append(rec_id)
-            invert_index.update(lambda_table)
+            tables = (group_block_keys(keys) for keys in lambda_fold_keys(clks, table_indices, self.chunk_size))
+
+        # add the Lambda fold tables to the invert index
+        invert_index = {}  # type: Dict[Tuple[int, int], List[Any]]
+        for i, (block_keys, members, offsets) in enumerate(tables):
+            grouped_ids = record_ids[members].tolist()
+            bounds = offsets.tolist()
+            for j, block_key in enumerate(block_keys.tolist()):
+                invert_index[(i, block_key)] = grouped_ids[bounds[j]:bounds[j + 1]]
 
         return invert_index
 
+    def split_blocks(self, reversed_index: Dict, block_keys: Set, data: Any, level: int,
+                     header: Optional[List[str]] = None):
+        """Split blocks by split-bits additional bits of the CLKs.
+
+        The additional bits are sampled for each table and level with a seed derived from random_state, so all
+        data providers sample the same bits. The integer formed by them is appended to the block key. Only the
+        records of the blocks to split are encoded, once for all of them.
+
+        :param reversed_index: dict mapping block keys to record IDs, as returned by build_reversed_index
+        :param block_keys: keys of the blocks to split
+        :param data: the data the reversed index was built from
+        :param level: number of times the blocks have been split before
+        :param header: file header, optional
+        :return: reversed index where each block in block_keys is replaced by its sub-blocks
+        """
+        row_map = self.get_record_to_row_map(data, self.record_id_col)
+        block_rows = {}  # type: Dict[Tuple[int, ...], np.ndarray]
+        for block_key, rec_ids in reversed_index.items():
+            if block_key in block_keys:
+                block_rows[block_key] = np.array(
+                    rec_ids if row_map is None else [row_map[rec_id] for rec_id in rec_ids], dtype=np.int64)
+        if not block_rows:
+            return reversed_index
+        rows = np.unique(np.concatenate(list(block_rows.values())))
+        clks, bf_len = self.__load_clk_rows__(data, rows, header)
+
+        split_indices = {}  # type: Dict[int, List[int]]
+        split_index = {}  # type: Dict[Tuple[int, ...], List[Any]]
+        for block_key, rec_ids in reversed_index.items():
+            if block_key not in block_keys:
+                split_index[block_key] = rec_ids
+                continue
+            table = block_key[0]
+            if table not in split_indices:
+                rng = random.Random('{}-{}-{}'.format(self.random_state, table, level))
+                split_indices[table] = rng.sample(range(bf_len), self.split_bits)
+            block_clks = clks[np.searchsorted(rows, block_rows[block_key])]
+            sub_keys, members, offsets = group_block_keys(lambda_table_keys(block_clks, split_indices[table]))
+            bounds = offsets.tolist()
+            for j, sub_key in enumerate(sub_keys.tolist()):
+                split_index[block_key + (sub_key,)] = [rec_ids[m] for m in members[bounds[j]:bounds[j + 1]].tolist()]
+        return split_index
+
+    def __parallel_shared_lambda_tables__(self, clks: np.ndarray, table_indices: List[List[int]]):
+        """Build the Lambda tables in a process pool which reads the CLKs from shared memory."""
+        shm = shared_memory.SharedMemory(create=True, size=max(clks.nbytes, 1))
+        try:
+            shared_clks = np.ndarray(clks.shape, dtype=np.uint8, buffer=shm.buf)
+            shared_clks[:] = clks
+            del shared_clks
+            tables = self.__parallel_lambda_tables__(('shm', shm.name, clks.shape), table_indices)
+        finally:
+            shm.close()
+            shm.unlink()
+        return tables
+
+    def __parallel_file_lambda_tables__(self, clks: np.ndarray, table_indices: List[List[int]]):
+        """Build the Lambda tables in a process pool which memory maps the CLKs from a temporary file."""
+        fd, path = tempfile.mkstemp(suffix='.npy')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(clks))
+            tables = self.__parallel_lambda_tables__(('file', path, clks.shape[1]), table_indices)
+        finally:
+            os.remove(path)
+        return tables
+
+    def __parallel_lambda_tables__(self, source: Tuple[str, Any, Any], table_indices: List[List[int]]):
+        """Build the Lambda tables in a process pool, each worker reads the CLKs from source."""
+        num_tables = len(table_indices)
+        with ProcessPoolExecutor(max_workers=min(self.workers, num_tables)) as executor:
+            # map returns the tables in submission order, so the result doesn't depend on scheduling
+            return list(executor.map(_lambda_table_worker, [source] * num_tables, table_indices,
+                                     [self.chunk_size] * num_tables))
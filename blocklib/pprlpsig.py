@@ -1,16 +1,47 @@
 import statistics
 from collections import defaultdict
-from typing import Dict, List, Sequence, Any, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Sequence, Any, Optional, Set, Union
 
 import numpy as np
 
 from .configuration import get_config
-from .encoding import flip_bloom_filter
+from .encoding import bit_positions, block_key_to_positions, positions_to_block_key
 from .pprlindex import PPRLIndex
-from .signature_generator import generate_signatures
+from .signature_generator import SignaturePlan, configure_transform_caches
 from .stats import reversed_index_per_strategy_stats
 
 
+def build_signature_indices(signature_plan: SignaturePlan, data: Sequence[Sequence],
+                            record_ids: Union[Sequence[Any], np.ndarray]):
+    """Build a reversed index {signature -> record ids} for each strategy of the signature plan."""
+    reversed_index_per_strategy = \
+        [defaultdict(list) for _ in range(len(signature_plan.strategies))]  # type: List[Dict[str, List[Any]]]
+    if signature_plan.columnar:
+        # generate the signatures of each strategy for all records at once
+        columns = {ind: [dtuple[ind] for dtuple in data] for ind in signature_plan.feature_indices}
+        for i, signature_column in enumerate(signature_plan.generate_columns(columns)):
+            strategy_index = reversed_index_per_strategy[i]
+            for rec_id, signature in zip(record_ids, signature_column):
+                strategy_index[signature].append(rec_id)
+    else:
+        for rec_id, dtuple in zip(record_ids, data):
+
+            signatures = signature_plan.generate(dtuple)
+
+            for i, signature in enumerate(signatures):
+                reversed_index_per_strategy[i][signature].append(rec_id)
+
+    return reversed_index_per_strategy
+
+
+def _signature_indices_worker(signature_strategies: List[List], feature_to_index: Optional[Dict[str, int]],
+                              data: Sequence[Sequence], record_ids: Union[Sequence[Any], np.ndarray]):
+    """Build the signature indices of a chunk of data. Runs in a worker process."""
+    signature_plan = SignaturePlan(signature_strategies, feature_to_index)
+    return [dict(reversed_index) for reversed_index in build_signature_indices(signature_plan, data, record_ids)]
+
+
 class PPRLIndexPSignature(PPRLIndex):
     """Class that implements the PPRL indexing technique:
 
@@ -34,6 +65,14 @@ class PPRLIndexPSignature(PPRLIndex):
         self.blocking_config = get_config(config, "blocking-filter")
         self.signature_strategies = get_config(config, 'signatureSpecs')
         self.rec_id_col = config.get("record-id-col", None)
+        # size of the shared caches of phonetic and other string transforms
+        transform_cache_size = config.get("transform-cache-size", None)
+        if transform_cache_size is not None:
+            configure_transform_caches(int(transform_cache_size))
+        # number of processes generating signatures
+        self.workers = int(config.get("workers", 1))
+        # signature strategies splitting oversized blocks, the i-th one is used at the i-th level of splitting
+        self.split_strategies = config.get("split-signatureSpecs", [])
 
     def build_reversed_index(self, data: Sequence[Sequence], verbose: bool = False, header: Optional[List[str]] = None):
         """Build inverted index given P-Sig method."""
@@ -46,16 +85,13 @@ class PPRLIndexPSignature(PPRLIndex):
         else:
             record_ids = [x[self.rec_id_col] for x in data]
 
-        reversed_index_per_strategy = \
-            [defaultdict(list) for _ in range(len(self.signature_strategies))]  # type: List[Dict[str, List[Any]]]
         # Build inverted index
         # {signature -> record ids}
-        for rec_id, dtuple in zip(record_ids, data):
-
-            signatures = generate_signatures(self.signature_strategies, dtuple, feature_to_index)
-
-            for i, signature in enumerate(signatures):
-                reversed_index_per_strategy[i][signature].append(rec_id)
+        if self.workers > 1 and len(data) > 1:
+            reversed_index_per_strategy = self.__parallel_signature_indices__(data, record_ids, feature_to_index)
+        else:
+            signature_plan = SignaturePlan(self.signature_strategies, feature_to_index)
+            reversed_index_per_strategy = build_signature_indices(signature_plan, data, record_ids)
 
         n = len(data)
         reversed_index_per_strategy = [self.filter_reversed_index(data, reversed_index) for reversed_index in
@@ -97,10 +133,11 @@ class PPRLIndexPSignature(PPRLIndex):
         num_hash_func = int(self.blocking_config.get("number-hash-functions", None))
         bf_len = int(self.blocking_config.get("bf-len", None))
 
-        reversed_index = {}  # type: Dict[str, List[Any]]
+        # block keys are the sorted positions of the bits flipped by the signature, encoded as bytes
+        reversed_index = {}  # type: Dict[bytes, List[Any]]
 
         for signature, rec_ids in filtered_reversed_index.items():
-            bf_set = str(tuple(flip_bloom_filter(signature, bf_len, num_hash_func)))
+            bf_set = positions_to_block_key(bit_positions(signature, bf_len, num_hash_func))
             if bf_set in reversed_index:
                 reversed_index[bf_set].extend(rec_ids)
             else:
@@ -108,6 +145,72 @@ class PPRLIndexPSignature(PPRLIndex):
 
         return reversed_index
 
+    def split_blocks(self, reversed_index: Dict, block_keys: Set, data: Sequence[Sequence], level: int,
+                     header: Optional[List[str]] = None):
+        """Split blocks by the signature strategy of split-signatureSpecs for this level.
+
+        The key of a sub-block is the sorted union of the bit positions of the block key and of the secondary
+        signature, so it can be filtered by generate_blocks like any other block. Blocks are returned unchanged
+        if there is no strategy left for this level.
+
+        :param reversed_index: dict mapping block keys to record IDs, as returned by build_reversed_index
+        :param block_keys: keys of the blocks to split
+        :param data: the data the reversed index was built from
+        :param level: number of times the blocks have been split before
+        :param header: file header, optional
+        :return: reversed index where each block in block_keys is replaced by its sub-blocks
+        """
+        if level >= len(self.split_strategies):
+            return reversed_index
+        feature_to_index = self.get_feature_to_index_map(data, header)
+        signature_plan = SignaturePlan([self.split_strategies[level]], feature_to_index)
+        row_map = self.get_record_to_row_map(data, self.rec_id_col)
+        num_hash_func = int(self.blocking_config.get("number-hash-functions", None))
+        bf_len = int(self.blocking_config.get("bf-len", None))
+
+        split_index = {}  # type: Dict[bytes, List[Any]]
+        for block_key, rec_ids in reversed_index.items():
+            if block_key not in block_keys:
+                sub_blocks = {block_key: rec_ids}
+            else:
+                sub_blocks = defaultdict(list)
+                for rec_id in rec_ids:
+                    signature = signature_plan.generate(data[rec_id if row_map is None else row_map[rec_id]])[0]
+                    bits = np.union1d(block_key_to_positions(block_key),
+                                      bit_positions('split{}_{}'.format(level, signature), bf_len, num_hash_func))
+                    sub_blocks[positions_to_block_key(bits)].append(rec_id)
+            # a sub-block key may coincide with the key of another block
+            for sub_key, sub_rec_ids in sub_blocks.items():
+                if sub_key in split_index:
+                    split_index[sub_key] = split_index[sub_key] + sub_rec_ids
+                else:
+                    split_index[sub_key] = sub_rec_ids
+        return split_index
+
+    def __parallel_signature_indices__(self, data: Sequence[Sequence],
+                                       record_ids: Union[Sequence[Any], np.ndarray],
+                                       feature_to_index: Optional[Dict[str, int]]):
+        """Build the signature indices of contiguous chunks of data in a process pool and merge them in order.
+
+        Merging the chunks in order keeps both the order of blocks and of record ids within a block identical
+        to building the indices in a single process.
+        """
+        chunk_size = -(-len(data) // self.workers)
+        starts = range(0, len(data), chunk_size)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            partial_indices = executor.map(_signature_indices_worker,
+                                           [self.signature_strategies] * len(starts),
+                                           [feature_to_index] * len(starts),
+                                           [data[start: start + chunk_size] for start in starts],
+                                           [record_ids[start: start + chunk_size] for start in starts])
+            reversed_index_per_strategy = \
+                [defaultdict(list) for _ in range(len(self.signature_strategies))]  # type: List[Dict[str, List[Any]]]
+            for partial_index_per_strategy in partial_indices:
+                for reversed_index, partial_index in zip(reversed_index_per_strategy, partial_index_per_strategy):
+                    for signature, rec_ids in partial_index.items():
+                        reversed_index[signature].extend(rec_ids)
+        return reversed_index_per_strategy
+
     def filter_reversed_index(self, data: Sequence[Sequence], reversed_index: Dict):
         # Filter inverted index based on ratio
         n = len(data)
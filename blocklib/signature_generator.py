@@ -1,60 +1,104 @@
-from typing import Any, Callable, Dict, List, Sequence, Optional
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Optional, Tuple
 
+import numpy as np
 from metaphone import doublemetaphone
 
+from .cache import LRUCache
+
+# default number of values cached by each transform cache
+DEFAULT_TRANSFORM_CACHE_SIZE = 2 ** 16
+
+# shared caches of string transforms used by signature strategies, keyed on the transform name
+TRANSFORM_CACHES = {}  # type: Dict[str, LRUCache]
+_transform_caches_lock = threading.Lock()
+
+
+def get_transform_cache(name: str):
+    """Return the shared cache of the string transform name, creating it if necessary.
+
+    Strategies which transform feature values, e.g. phonetic encodings, should look up and store
+    their results in this cache.
+    """
+    with _transform_caches_lock:
+        if name not in TRANSFORM_CACHES:
+            TRANSFORM_CACHES[name] = LRUCache(DEFAULT_TRANSFORM_CACHE_SIZE)
+        return TRANSFORM_CACHES[name]
+
+
+def configure_transform_caches(maxsize: int):
+    """Set the size of all transform caches, including the ones created later."""
+    global DEFAULT_TRANSFORM_CACHE_SIZE
+    with _transform_caches_lock:
+        DEFAULT_TRANSFORM_CACHE_SIZE = maxsize
+        for cache in TRANSFORM_CACHES.values():
+            cache.resize(maxsize)
+
 
 def generate_by_feature_value(attr_ind: int, dtuple: Sequence):
     """Generate signatures by simply return original feature at attr_ind."""
     return dtuple[attr_ind]
 
 
-def generate_by_char_at(attr_ind: int, dtuple: Sequence, pos: List[Any]):
-    """ Generate signatures by select subset of characters in original features.
-    >>> res = generate_by_char_at(2, ('harry potter', '4 Privet Drive', 'Little Whinging', 'Surrey'), [0, 3])
-    >>> assert res == 'Lt'
-    >>> res = generate_by_char_at(2, ('harry potter', '4 Privet Drive', 'Little Whinging', 'Surrey'), [":4"])
-    >>> assert res == 'Litt'
-    """
-    sig = []
-    feature = dtuple[attr_ind]
-
-    # missing value
-    if feature == '':
-        return None
+def parse_char_positions(pos: List[Any]):
+    """Parse the positions of characters-at into (start, end, is_slice) tuples.
 
-    max_ind = len(feature)
+    >>> parse_char_positions([0, '2', ':4', '1:'])
+    [(0, None, False), (2, None, False), (None, 4, True), (1, None, True)]
+    """
+    positions = []  # type: List[Tuple[Optional[int], Optional[int], bool]]
     for p in pos:
         if type(p) == int:
-            p = min(p, max_ind - 1)
-            sig.append(feature[p])
+            positions.append((p, None, False))
         elif ':' not in p:
-            p = int(p)
-            p = min(p, max_ind - 1)
-            sig.append(feature[p])
+            positions.append((int(p), None, False))
         else:
             start_ind, end_ind = p.split(":")
             if start_ind != '' and end_ind != '':
-                start_ind = int(start_ind)
-                end_ind = int(end_ind)
-                assert start_ind < end_ind, "Start index should be less than End index in {}".format(p)
-                start_ind = min(start_ind, max_ind - 1)
-                end_ind = min(end_ind, max_ind)
-                c = feature[start_ind: end_ind]
+                start, end = int(start_ind), int(end_ind)
+                assert start < end, "Start index should be less than End index in {}".format(p)
+                positions.append((start, end, True))
             elif start_ind == '' and end_ind != '':
-                end_ind = int(end_ind)
-                end_ind = min(end_ind, max_ind)
-                c = feature[:end_ind]
+                positions.append((None, int(end_ind), True))
             elif start_ind != '' and end_ind == '':
-                start_ind = int(start_ind)
-                start_ind = min(start_ind, max_ind)
-                c = feature[start_ind:]
+                positions.append((int(start_ind), None, True))
             else:
                 raise ValueError('Invalid pos argument: {}'.format(p))
-            sig.append(c)
+    return positions
+
+
+def chars_at(feature: str, positions: List[Tuple[Optional[int], Optional[int], bool]]):
+    """Select the characters of feature at positions parsed by parse_char_positions."""
+    # missing value
+    if feature == '':
+        return None
+
+    sig = []
+    max_ind = len(feature)
+    for start, end, is_slice in positions:
+        if not is_slice:
+            sig.append(feature[min(start, max_ind - 1)])  # type: ignore
+        elif start is not None and end is not None:
+            sig.append(feature[min(start, max_ind - 1): min(end, max_ind)])
+        elif end is not None:
+            sig.append(feature[:min(end, max_ind)])
+        else:
+            sig.append(feature[min(start, max_ind):])  # type: ignore
 
     return ''.join(sig)
 
 
+def generate_by_char_at(attr_ind: int, dtuple: Sequence, pos: List[Any]):
+    """ Generate signatures by select subset of characters in original features.
+    >>> res = generate_by_char_at(2, ('harry potter', '4 Privet Drive', 'Little Whinging', 'Surrey'), [0, 3])
+    >>> assert res == 'Lt'
+    >>> res = generate_by_char_at(2, ('harry potter', '4 Privet Drive', 'Little Whinging', 'Surrey'), [":4"])
+    >>> assert res == 'Litt'
+    """
+    return chars_at(dtuple[attr_ind], parse_char_positions(pos))
+
+
 def generate_by_metaphone(attr_ind: int, dtuple: Sequence):
     """Generate a phonetic encoding of features using metaphone.
 
@@ -62,9 +106,15 @@ def generate_by_metaphone(attr_ind: int, dtuple: Sequence):
     'SM0XMT'
 
     """
-    feature = dtuple[attr_ind]
-    phonetic_encoding = doublemetaphone(feature)
-    return ''.join(phonetic_encoding)
+    return metaphone_encoding(dtuple[attr_ind])
+
+
+def metaphone_encoding(feature: str):
+    """Return the concatenated primary and secondary double metaphone encodings of feature."""
+    return _METAPHONE_CACHE.get_or_compute(feature, lambda: ''.join(doublemetaphone(feature)))
+
+
+_METAPHONE_CACHE = get_transform_cache('metaphone')
 
 
 #################################################
@@ -78,11 +128,152 @@ SIGNATURE_STRATEGIES = {
 }  # type: Dict[str, Callable[..., str]]
 
 
+class CompiledSpec:
+    """One signature spec with its feature index, strategy function and arguments resolved.
+
+    Built-in strategies are compiled to a transform of the feature value, which also allows to
+    generate the signatures of a whole column at once.
+    """
+
+    def __init__(self, attr_ind: int, transform: Optional[Callable[[str], Optional[str]]],
+                 func: Callable[..., Optional[str]], config: Dict) -> None:
+        self.attr_ind = attr_ind
+        self.transform = transform
+        self.func = func
+        self.config = config
+
+    def __call__(self, dtuple: Sequence):
+        """Return the signature of one record, or None for a missing value."""
+        if self.transform is not None:
+            return self.transform(str(dtuple[self.attr_ind]))
+        return self.func(attr_ind=self.attr_ind, dtuple=[str(x) for x in dtuple], **self.config)
+
+    def apply_column(self, column: Sequence):
+        """Return the signatures of a whole column of feature values, transforming each distinct value once."""
+        assert self.transform is not None, 'Only built-in strategies can be applied to columns'
+        if isinstance(column, np.ndarray) and column.dtype.kind == 'U':
+            # a NumPy string array is converted to Python strings in one call
+            values = column.tolist()
+        else:
+            values = [str(x) for x in column]
+        if self.transform is str:
+            return values
+        signatures = {value: self.transform(value) for value in set(values)}
+        return [signatures[value] for value in values]
+
+
+def compile_signature_spec(spec: Dict, feature_to_index: Optional[Dict[str, int]] = None):
+    """Resolve feature index, strategy function and its arguments of one signature spec.
+
+    :return: a CompiledSpec
+    """
+    # arguments that we need to pass for any strategy
+    attr = spec.get("feature", -1)
+    if type(attr) == str:
+        assert feature_to_index
+        attr_ind = feature_to_index.get(attr, None)
+        if attr_ind is None:
+            raise ValueError(f'Feature {attr} is not in the dataset')
+    else:
+        attr_ind = attr
+    config = spec.get('config', {})
+
+    # find the correct strategy function to call
+    func = SIGNATURE_STRATEGIES.get(spec['type'], None)
+
+    transform = None  # type: Optional[Callable[[str], Optional[str]]]
+    if func is None:
+        strategy_type = spec['type']
+        raise NotImplementedError('Strategy {} is not implemented yet!'.format(strategy_type))
+    elif func is generate_by_feature_value:
+        transform = str
+    elif func is generate_by_char_at:
+        transform = functools.partial(chars_at, positions=parse_char_positions(config['pos']))
+    elif func is generate_by_metaphone:
+        transform = metaphone_encoding
+    return CompiledSpec(attr_ind, transform, func, config)
+
+
+class SignaturePlan:
+    """Signature strategies compiled once so that they can be applied to many records.
+
+    Feature names, strategy functions and their arguments are resolved when the plan is created,
+    so generating the signatures of a record doesn't repeat any of this work.
+    """
+
+    def __init__(self, signature_strategies: List[List], feature_to_index: Optional[Dict[str, int]] = None) -> None:
+        """Compile a list of signature strategies.
+
+        :param signature_strategies:
+            A list of dicts each describing a strategy to generate signatures.
+
+        :param feature_to_index:
+            Mapping from feature name to feature index
+        """
+        self.strategies = []  # type: List[Tuple[str, List[CompiledSpec]]]
+        for i, strategy in enumerate(signature_strategies):
+            specs = [compile_signature_spec(spec, feature_to_index) for spec in strategy]
+            self.strategies.append(('{}_'.format(i), specs))
+
+    def generate(self, dtuple: Sequence):
+        """Generate signatures for one record.
+
+        :param dtuple:
+            Raw data to generate signatures from
+
+        :return signatures: list of str, one per strategy
+        """
+        signatures = []
+        for prefix, specs in self.strategies:
+            sig = [spec(dtuple) for spec in specs]
+            signatures.append(prefix + "_".join([x for x in sig if x is not None]))
+        return signatures
+
+    @property
+    def columnar(self):
+        """Whether all strategies can be applied to whole columns."""
+        return all(spec.transform is not None for _, specs in self.strategies for spec in specs)
+
+    @property
+    def feature_indices(self):
+        """Indices of the features used by the strategies."""
+        return sorted({spec.attr_ind for _, specs in self.strategies for spec in specs})
+
+    def generate_columns(self, columns: Mapping[int, Sequence]):
+        """Generate signatures for whole columns of records at once.
+
+        Each transform runs once per distinct value of a column instead of once per record, and the signatures
+        of a strategy are joined in one pass over its columns. Slicing and joining are not done with np.char:
+        characters-at clamps the positions to the length of every value and missing values are left out of the
+        joined signature, which the element-wise NumPy string functions don't express. Blocking features
+        usually repeat a lot, so transforming the distinct values does less work than array operations over
+        every record would.
+
+        :param columns:
+            Mapping from feature index to the column of feature values, e.g. a list or NumPy string array.
+            All features in feature_indices must be present.
+
+        :return signatures: list of signature columns, one per strategy
+        """
+        assert self.columnar, 'Only built-in strategies can be applied to columns'
+        signature_columns = []
+        for prefix, specs in self.strategies:
+            sig_columns = [spec.apply_column(columns[spec.attr_ind]) for spec in specs]
+            if len(sig_columns) == 1:
+                signature_columns.append([prefix if x is None else prefix + x for x in sig_columns[0]])
+            else:
+                signature_columns.append([prefix + "_".join([x for x in sig if x is not None])
+                                          for sig in zip(*sig_columns)])
+        return signature_columns
+
+
 def generate_signatures(signature_strategies: List[List],
                         dtuple: Sequence,
                         feature_to_index: Optional[Dict[str, int]] = None):
     """Generate signatures for one record.
 
+    Use SignaturePlan directly to generate signatures of many records.
+
     :param signature_strategies:
         A list of dicts each describing a strategy to generate signatures.
 
@@ -94,37 +285,4 @@ def generate_signatures(signature_strategies: List[List],
 
     :return signatures: set of str
     """
-    # signatures to return
-    signatures = []
-
-    # loop through each strategy
-
-    for i, strategy in enumerate(signature_strategies):
-        sig = []
-        for spec in strategy:
-            # arguments that we need to pass for any strategy
-            attr = spec.get("feature", -1)
-            if type(attr) == str:
-                assert feature_to_index
-                attr_ind = feature_to_index.get(attr, None)
-                if attr_ind is None:
-                    raise ValueError(f'Feature {attr} is not in the dataset')
-            else:
-                attr_ind = attr
-            args = dict(attr_ind=attr_ind, dtuple=[str(x) for x in dtuple])
-            config = spec.get('config', {})
-
-            # find the correct strategy function to call
-            func = SIGNATURE_STRATEGIES.get(spec['type'], None)
-
-            if func is None:
-                strategy_type = spec['type']
-                print(spec)
-                raise NotImplementedError('Strategy {} is not implemented yet!'.format(strategy_type))
-            else:
-                config.update(args)
-                s = func(**config)
-                sig.append(s)
-        signatures.append('{}_{}'.format(i, "_".join([x for x in sig if x is not None])))
-
-    return signatures
+    return SignaturePlan(signature_strategies, feature_to_index).generate(dtuple)
@@ -0,0 +1,225 @@
+"""Module that verifies the candidate pairs of the final blocks with a thresholded similarity join."""
+from collections import Counter, defaultdict
+import itertools
+import math
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Set, Tuple
+
+from .simmeasure import DiceSim, EditSim, SimMeasure
+
+
+def similarity_join(blocks: Any, strings: Sequence[Any], sim_measure: SimMeasure, threshold: float,
+                    q: int = 2) -> List[Tuple[Any, Any, float]]:
+    """
+    Return the pairs of records of 2 data providers in a common block with a similarity of at least threshold.
+
+    See iter_similarity_join.
+    """
+    return list(iter_similarity_join(blocks, strings, sim_measure, threshold, q))
+
+
+def iter_similarity_join(blocks: Any, strings: Sequence[Any], sim_measure: SimMeasure, threshold: float,
+                         q: int = 2) -> Iterator[Tuple[Any, Any, float]]:
+    """
+    Verify the pairs of records of 2 data providers in a common block, one block at a time.
+
+    Before the similarity of a pair is computed, pairs which can't reach the threshold are pruned. For DiceSim,
+    candidates are generated by prefix filtering on the q-gram sets ordered by rarity in the block, and pruned by
+    length filtering and by the count of q-grams they can share at most. For EditSim, candidates are generated by
+    prefix filtering on the q-grams of length q, and pruned by length filtering and by the number of q-grams
+    strings within the allowed edit distance share. If the min_threshold of EditSim is larger than threshold,
+    only length filtering is applied. Other measures are computed for every pair.
+    The similarity of the remaining pairs is the one of sim_measure, and each pair is verified once even if it
+    shares several blocks.
+
+    :param blocks: either the output of generate_blocks for 2 data providers or an iterable of
+        (block_key, [record IDs of party a, record IDs of party b]) as returned by iter_blocks
+    :param strings: for each of the 2 data providers, the string of each record, indexed by record ID
+    :param sim_measure: a SimMeasure instance
+    :param threshold: minimum similarity of the returned pairs, must be positive
+    :param q: length of the q-grams used to filter EditSim pairs
+    :return: generator of (record ID of party a, record ID of party b, similarity) tuples
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError('Threshold must be in (0, 1], got {}'.format(threshold))
+    if q < 1:
+        raise ValueError('q must be positive, got {}'.format(q))
+    strings_a, strings_b = strings
+    verified = set()  # type: Set[Tuple[Any, Any]]
+    for _, (recs_a, recs_b) in _block_records(blocks):
+        block_strings_a = [strings_a[rec] for rec in recs_a]
+        block_strings_b = [strings_b[rec] for rec in recs_b]
+        for i, j in candidate_positions(block_strings_a, block_strings_b, sim_measure, threshold, q):
+            pair = (recs_a[i], recs_b[j])
+            if pair in verified:
+                continue
+            verified.add(pair)
+            if isinstance(sim_measure, EditSim):
+                score = sim_measure.bit_parallel_sim(block_strings_a[i], block_strings_b[j])
+            else:
+                score = sim_measure.sim(block_strings_a[i], block_strings_b[j])
+            if score >= threshold:
+                yield recs_a[i], recs_b[j], score
+
+
+def _block_records(blocks: Any) -> Iterable[Tuple[Any, Sequence[Sequence[Any]]]]:
+    """Return the blocks as (block_key, [record IDs of party a, record IDs of party b]) tuples."""
+    if isinstance(blocks, Sequence) and len(blocks) == 2 and all(isinstance(index, dict) for index in blocks):
+        reversed_index_a, reversed_index_b = blocks
+        return ((key, [recs_a, reversed_index_b[key]]) for key, recs_a in reversed_index_a.items()
+                if key in reversed_index_b)
+    return blocks
+
+
+def candidate_positions(strings_a: Sequence[str], strings_b: Sequence[str], sim_measure: SimMeasure,
+                        threshold: float, q: int = 2) -> List[Tuple[int, int]]:
+    """
+    Return the positions (i, j) of the pairs of strings of a block which pass the filters of sim_measure.
+    No pair with a similarity of at least threshold is pruned.
+    """
+    if isinstance(sim_measure, DiceSim):
+        return dice_candidates(strings_a, strings_b, sim_measure, threshold)
+    if isinstance(sim_measure, EditSim):
+        min_threshold = sim_measure.min_threshold
+        if min_threshold is not None and min_threshold > threshold:
+            # pairs failing the length filter of sim score 0, the others may score below their edit similarity
+            return edit_length_candidates(strings_a, strings_b, min_threshold)
+        return edit_candidates(strings_a, strings_b, threshold, q)
+    return [(i, j) for i in range(len(strings_a)) for j in range(len(strings_b))]
+
+
+def dice_candidates(strings_a: Sequence[str], strings_b: Sequence[str], sim_measure: DiceSim,
+                    threshold: float) -> List[Tuple[int, int]]:
+    """Return the pairs of a block whose Dice similarity may reach threshold, using prefix, length and count
+    filtering on the q-gram sets."""
+    qgrams_a = [sim_measure.qgram_set(string) for string in strings_a]
+    qgrams_b = [sim_measure.qgram_set(string) for string in strings_b]
+    # order q-grams by rarity, so that prefixes hold the rarest q-grams
+    frequency = Counter(itertools.chain.from_iterable(grams for grams, _ in itertools.chain(qgrams_a, qgrams_b)))
+    sorted_a = [sorted(grams, key=lambda gram: (frequency[gram], gram)) for grams, _ in qgrams_a]
+    sorted_b = [sorted(grams, key=lambda gram: (frequency[gram], gram)) for grams, _ in qgrams_b]
+
+    # a pair with similarity at least threshold shares at least _dice_min_overlap q-grams
+    prefix_index = defaultdict(list)  # type: Dict[str, List[Tuple[int, int]]]
+    for j, (grams, (_, length)) in enumerate(zip(sorted_b, qgrams_b)):
+        for pos_b, gram in enumerate(grams[:len(grams) - _dice_min_overlap(threshold, length) + 1]):
+            prefix_index[gram].append((j, pos_b))
+
+    candidates = set()
+    for i, (grams, (_, length_a)) in enumerate(zip(sorted_a, qgrams_a)):
+        # position of the first shared q-gram in both prefixes, which is the first shared q-gram of the pair
+        first_shared = {}  # type: Dict[int, Tuple[int, int]]
+        for pos_a, gram in enumerate(grams[:len(grams) - _dice_min_overlap(threshold, length_a) + 1]):
+            for j, pos_b in prefix_index.get(gram, ()):
+                first_shared.setdefault(j, (pos_a, pos_b))
+        for j, (pos_a, pos_b) in first_shared.items():
+            length_b = qgrams_b[j][1]
+            # length filter: the pair can't share more q-grams than the smaller set holds
+            if 2.0 * min(len(grams), len(sorted_b[j])) / (length_a + length_b) < threshold:
+                continue
+            # count filter: no q-gram before the first shared one is shared
+            max_common = 1 + min(len(grams) - pos_a - 1, len(sorted_b[j]) - pos_b - 1)
+            if 2.0 * max_common / (length_a + length_b) < threshold:
+                continue
+            candidates.add((i, j))
+
+    # equal strings have similarity 1.0 even without shared q-grams
+    candidates.update(_equal_pairs(strings_a, strings_b))
+    return sorted(candidates)
+
+
+def _dice_min_overlap(threshold: float, length: int) -> int:
+    # 2c / (length + other length) >= threshold and c <= other length give c >= threshold * length / (2 - threshold)
+    return max(1, int(math.ceil(threshold * length / (2 - threshold) - 1e-9)))
+
+
+def _equal_pairs(strings_a: Sequence[str], strings_b: Sequence[str]):
+    positions_b = defaultdict(list)  # type: Dict[str, List[int]]
+    for j, string in enumerate(strings_b):
+        positions_b[string].append(j)
+    return [(i, j) for i, string in enumerate(strings_a) for j in positions_b.get(string, ())]
+
+
+def edit_length_candidates(strings_a: Sequence[str], strings_b: Sequence[str],
+                           threshold: float) -> List[Tuple[int, int]]:
+    """Return the pairs of non-empty strings of a block whose length difference allows an edit similarity of at
+    least threshold."""
+    return [(i, j) for i, string_a in enumerate(strings_a) for j, string_b in enumerate(strings_b)
+            if string_a and string_b and _length_similarity(len(string_a), len(string_b)) >= threshold]
+
+
+def _length_similarity(n: int, m: int) -> float:
+    # the edit similarity of strings of length n and m is at most their length similarity, computed as in EditSim
+    return 1.0 - float(abs(n - m)) / float(max(n, m))
+
+
+def _max_edit_distance(max_len: int, threshold: float) -> int:
+    """Return the largest edit distance of strings with at most max_len characters with a similarity of at
+    least threshold."""
+    dist = int((1.0 - threshold) * max_len)
+    while dist < max_len and 1.0 - float(dist + 1) / float(max_len) >= threshold:
+        dist += 1
+    while dist > 0 and 1.0 - float(dist) / float(max_len) < threshold:
+        dist -= 1
+    return dist
+
+
+def edit_candidates(strings_a: Sequence[str], strings_b: Sequence[str], threshold: float,
+                    q: int = 2) -> List[Tuple[int, int]]:
+    """Return the pairs of a block whose edit similarity may reach threshold, using prefix, length and count
+    filtering on q-grams.
+
+    Every edit operation destroys at most q q-grams. Strings within edit distance tau thus share all but q * tau
+    of the q-grams of the longer string, and their first q * tau + 1 q-grams in a global order share one q-gram.
+    """
+    def qgram_tokens(string: str):
+        # the q-grams as a multiset, every repetition of a q-gram is a distinct token
+        counts = Counter()  # type: Counter
+        tokens = []
+        for k in range(len(string) - q + 1):
+            gram = string[k:k + q]
+            tokens.append((gram, counts[gram]))
+            counts[gram] += 1
+        return tokens
+
+    tokens_a = [qgram_tokens(string) for string in strings_a]
+    tokens_b = [qgram_tokens(string) for string in strings_b]
+    frequency = Counter(itertools.chain.from_iterable(itertools.chain(tokens_a, tokens_b)))
+    max_len_a = max((len(string) for string in strings_a), default=0)
+    max_len_b = max((len(string) for string in strings_b), default=0)
+
+    def prefix(tokens: List[Tuple[str, int]], length: int, max_len_other: int):
+        # None if the string has too few q-grams to be filtered by its prefix
+        prefix_len = q * _max_edit_distance(max(length, max_len_other), threshold) + 1
+        if len(tokens) < prefix_len:
+            return None
+        return sorted(tokens, key=lambda token: (frequency[token], token))[:prefix_len]
+
+    prefix_index = defaultdict(list)  # type: Dict[Tuple[str, int], List[int]]
+    unfiltered_b = []
+    for j, (string, tokens) in enumerate(zip(strings_b, tokens_b)):
+        tokens_prefix = prefix(tokens, len(string), max_len_a)
+        if tokens_prefix is None:
+            unfiltered_b.append(j)
+        else:
+            for token in tokens_prefix:
+                prefix_index[token].append(j)
+
+    candidates = []
+    for i, (string_a, tokens) in enumerate(zip(strings_a, tokens_a)):
+        if not string_a:
+            continue
+        tokens_prefix = prefix(tokens, len(string_a), max_len_b)
+        if tokens_prefix is None:
+            probed = range(len(strings_b))  # type: Iterable[int]
+        else:
+            probed = set(itertools.chain(unfiltered_b, *(prefix_index.get(token, ()) for token in tokens_prefix)))
+        for j in sorted(probed):
+            string_b = strings_b[j]
+            if not string_b or _length_similarity(len(string_a), len(string_b)) < threshold:
+                continue
+            max_len = max(len(string_a), len(string_b))
+            min_common = max_len - q + 1 - q * _max_edit_distance(max_len, threshold)
+            if min_common > 0 and len(set(tokens).intersection(tokens_b[j])) < min_common:
+                continue
+            candidates.append((i, j))
+    return candidates
@@ -1,8 +1,21 @@
 """Similarity Measure Algorithms."""
 from blocklib.configuration import get_config
+from blocklib.cache import LRUCache
+import itertools
 import logging
+import threading
 from abc import ABC
-from typing import Dict, List, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+# default number of entries of each DiceSim cache
+DEFAULT_DICE_CACHE_SIZE = 2 ** 16
+
+# caches shared by DiceSim instances with cache_scope 'shared', keyed by cache kind and q-gram parameters
+_SHARED_DICE_CACHES = {}  # type: Dict[Tuple, LRUCache]
+_SHARED_DICE_CACHES_LOCK = threading.Lock()
 
 
 class SimMeasure(ABC):
@@ -31,12 +44,54 @@ class EditSim(SimMeasure):
     def sim(self, str1: str, str2: str, cache: bool = False):
         """Return sim score between 0 to 1.
         """
+        score, max_dist = self._prelude(str1, str2)
+        if score is not None:
+            return score
         min_threshold = self.min_threshold
+
+        n = len(str1)
+        m = len(str2)
+        max_len = max(n, m)
+
+        if n > m:  # Make sure n <= m, to use O(min(n,m)) space
+            str1, str2 = str2, str1
+            n, m = m, n
+
+        current = list(range(n + 1))
+
+        for i in range(1, m + 1):
+            previous = current
+            current = [i] + n * [0]
+            str2char = str2[i - 1]
+
+            for j in range(1, n + 1):
+                substitute = previous[j - 1]
+                if str1[j - 1] != str2char:
+                    substitute += 1
+
+                # Get minimum of insert, delete and substitute
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, substitute)
+
+            if (min_threshold is not None) and (min(current) > max_dist):
+                return 1.0 - float(max_dist + 1) / float(max_len)
+
+        w = 1.0 - float(current[n]) / float(max_len)
+        return w
+
+    def _prelude(self, str1: str, str2: str) -> Tuple[Optional[float], float]:
+        """Handle empty and equal strings and the length filter of min_threshold.
+
+        :return: A 2-tuple containing
+            the similarity if it is known without computing the edit distance, otherwise None
+            the maximum distance allowed by min_threshold
+        """
+        min_threshold = self.min_threshold
+        max_dist = 0.0
         # Quick check if the strings are empty or the same
         if (str1 == '') or (str2 == ''):
-            return 0.0
+            return 0.0, max_dist
         elif str1 == str2:
-            return 1.0
+            return 1.0, max_dist
 
         n = len(str1)
         m = len(str2)
@@ -49,7 +104,7 @@ class EditSim(SimMeasure):
                 w = 1.0 - float(len_diff) / float(max_len)
 
                 if w < min_threshold:
-                    return 0.0  # Similarity is smaller than minimum threshold
+                    return 0.0, max_dist  # Similarity is smaller than minimum threshold
 
                 else:  # Calculate the maximum distance possible with this threshold
                     max_dist = (1.0 - min_threshold) * max_len
@@ -58,39 +113,109 @@ class EditSim(SimMeasure):
                 msg = 'Illegal value for minimum threshold (not between 0 and 1): {}'.format(min_threshold)
                 raise ValueError(msg)
 
-        if n > m:  # Make sure n <= m, to use O(min(n,m)) space
-            str1, str2 = str2, str1
-            n, m = m, n
-
-        current = list(range(n + 1))
+        return None, max_dist
 
-        for i in range(1, m + 1):
-            previous = current
-            current = [i] + n * [0]
-            str2char = str2[i - 1]
+    def bit_parallel_sim(self, str1: str, str2: str):
+        """Return the same sim score as sim, computing the edit distance with the bit-parallel algorithm of
+           Myers and Hyyrö, where one Python integer holds a row of the dynamic program.
+        """
+        score, max_dist = self._prelude(str1, str2)
+        if score is not None:
+            return score
 
-            for j in range(1, n + 1):
-                substitute = previous[j - 1]
-                if str1[j - 1] != str2char:
-                    substitute += 1
+        n = len(str1)
+        m = len(str2)
+        max_len = max(n, m)
 
-                # Get minimum of insert, delete and substitute
-                current[j] = min(previous[j] + 1, current[j - 1] + 1, substitute)
+        if n > m:  # the bits of the shorter string hold a row
+            str1, str2 = str2, str1
+            n, m = m, n
 
-            if (min_threshold is not None) and (min(current) > max_dist):
+        # bit j of the vertical deltas is the difference between the distances to str1[:j+1] and str1[:j]
+        positive, negative, dist = _myers_last_row(str1, str2)
+
+        # the minimum of a row never decreases, so sim stops early iff the minimum of the last row is too large
+        if self.min_threshold is not None:
+            row_min = current = m
+            for j in range(n):
+                if positive >> j & 1:
+                    current += 1
+                elif negative >> j & 1:
+                    current -= 1
+                    row_min = min(row_min, current)
+            if row_min > max_dist:
                 return 1.0 - float(max_dist + 1) / float(max_len)
 
-        w = 1.0 - float(current[n]) / float(max_len)
+        w = 1.0 - float(dist) / float(max_len)
         return w
 
+    def sim_many(self, pairs: Iterable[Tuple[str, str]], workers: Optional[int] = None) -> List[float]:
+        """Return the sim score of every pair of strings, identical to calling sim on each pair.
+
+        :param pairs: iterable of (str1, str2) tuples
+        :param workers: number of processes to spread the pairs over, by default the pairs are compared in this
+            process
+        """
+        pairs = list(pairs)
+        if workers is None or workers <= 1 or len(pairs) < 2:
+            return [self.bit_parallel_sim(str1, str2) for str1, str2 in pairs]
+        # a few chunks per worker balance the load if string lengths vary
+        chunk_size = -(-len(pairs) // (4 * workers))
+        chunks = [pairs[start: start + chunk_size] for start in range(0, len(pairs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = executor.map(_edit_sim_worker, [self.min_threshold] * len(chunks), chunks)
+            return list(itertools.chain.from_iterable(scores))
+
+
+def _myers_last_row(str1: str, str2: str):
+    """Run the bit-parallel edit distance of str1 against str2.
+
+    :return: A 3-tuple containing
+        bitmask of the positions j where the distance of str2 to str1[:j+1] is one more than to str1[:j]
+        bitmask of the positions j where it is one less
+        the edit distance of str1 and str2
+    """
+    n = len(str1)
+    mask = (1 << n) - 1
+    high_bit = 1 << (n - 1)
+    peq = {}  # type: Dict[str, int]
+    for j, char in enumerate(str1):
+        peq[char] = peq.get(char, 0) | (1 << j)
+
+    positive, negative, dist = mask, 0, n
+    for char in str2:
+        eq = peq.get(char, 0)
+        xv = eq | negative
+        xh = (((eq & positive) + positive) ^ positive) | eq
+        ph = negative | (~(xh | positive) & mask)
+        mh = positive & xh
+        if ph & high_bit:
+            dist += 1
+        elif mh & high_bit:
+            dist -= 1
+        # the distance to the empty prefix of str1 grows by one with every character of str2
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        positive = mh | (~(xv | ph) & mask)
+        negative = ph & xv
+    return positive, negative, dist
+
+
+def _edit_sim_worker(min_threshold: Optional[float], pairs: List[Tuple[str, str]]):
+    """Compare a chunk of pairs. Runs in a worker process."""
+    return EditSim({'min_threshold': min_threshold}).sim_many(pairs)
+
 
 class DiceSim(SimMeasure):
     """Class that implements the Dice coefficient for the two input strings.
        This methods uses the constants: ngram_len and ngram_padding (and if this
        constant is set to True also padding_start_char and self.padding_end_char).
 
-       If the argument cache is set to True then the generated q-gram lists
-       will be stored in a dictionary to prevent their repeated computation.
+       If the argument cache is set to True then the generated q-gram sets
+       will be stored in an LRU cache to prevent their repeated computation.
+       The optional config q_gram_cache_size and sim_cache_size bound the caches,
+       and cache_scope 'shared' shares them with all instances using the same q-grams.
+       A shared cache only grows to the largest size given explicitly by its instances.
     """
 
     def __init__(self, config: Dict):
@@ -100,11 +225,25 @@ class DiceSim(SimMeasure):
         self.padding_start_char = get_config(config, 'padding_start_char')
         self.padding_end_char = get_config(config, 'padding_end_char')
 
-        # Store strings converted into q-grams. Keys in this will be strings and their values their q-gram list
-        self.q_gram_cache = {}  # type: Dict[str, List[str]]
+        q_gram_cache_size = config.get('q_gram_cache_size')
+        sim_cache_size = config.get('sim_cache_size')
+        cache_scope = config.get('cache_scope', 'instance')
+        if cache_scope == 'instance':
+            q_gram_cache = LRUCache(DEFAULT_DICE_CACHE_SIZE if q_gram_cache_size is None else int(q_gram_cache_size))
+            sim_cache = LRUCache(DEFAULT_DICE_CACHE_SIZE if sim_cache_size is None else int(sim_cache_size))
+        elif cache_scope == 'shared':
+            params = (self.ngram_len, self.ngram_padding, self.padding_start_char, self.padding_end_char)
+            q_gram_cache = _shared_dice_cache(('q_gram',) + params, q_gram_cache_size)
+            sim_cache = _shared_dice_cache(('sim',) + params, sim_cache_size)
+        else:
+            raise ValueError("cache_scope must be 'instance' or 'shared', got {}".format(cache_scope))
+
+        # Store strings converted into q-grams. Keys in this will be strings and their values the set of their
+        # q-grams and the number of q-grams
+        self.q_gram_cache = q_gram_cache
 
-        # Store the string pair and its similarity in a cache as well
-        self.sim_cache = {}  # type: Dict[Tuple[str, str], float]
+        # Store the string pair and its similarity in a cache as well, the pair is ordered as the measure is symmetric
+        self.sim_cache = sim_cache
 
     def sim(self, s1: str, s2: str, cache: bool = False):
         """Calculate the similarity between the given two strings. The method
@@ -117,38 +256,148 @@ class DiceSim(SimMeasure):
             return 1.0
 
         # Check if the string pair has been compared before
-        if (s1, s2) in self.sim_cache:
-            return self.sim_cache[(s1, s2)]
+        pair = (s1, s2) if s1 < s2 else (s2, s1)
+        sim = self.sim_cache.get(pair)
+        if sim is not None:
+            return sim
 
         q_minus_1 = self.ngram_len - 1
 
-        # Convert input strings into q-gram lists
-        l1 = self._convert_to_qgrams(s1, q_minus_1, cache)
-        l2 = self._convert_to_qgrams(s2, q_minus_1, cache)
+        # Convert input strings into q-gram sets
+        set1, len1 = self._convert_to_qgrams(s1, q_minus_1, cache)
+        set2, len2 = self._convert_to_qgrams(s2, q_minus_1, cache)
 
-        common = len(set(l1).intersection(set(l2)))
+        common = len(set1.intersection(set2))
 
-        sim = 2.0 * common / (len(l1) + len(l2))
+        sim = 2.0 * common / (len1 + len2)
 
         if cache:
-            self.sim_cache[(s1, s2)] = sim
+            self.sim_cache.put(pair, sim)
 
         return sim
 
-    def _convert_to_qgrams(self, inputstr: str, q_minus_1: int, cache: bool):
-        if cache and (inputstr in self.q_gram_cache):
-            qgrams = self.q_gram_cache[inputstr]
+    def qgram_set(self, inputstr: str, cache: bool = False) -> Tuple[FrozenSet[str], int]:
+        """Return the set of q-grams of the string and the number of its q-grams, as used by sim."""
+        return self._convert_to_qgrams(inputstr, self.ngram_len - 1, cache)
+
+    def cache_stats(self):
+        """Return hit, miss and eviction counters of the q-gram and the similarity cache."""
+        return {'q_gram_cache': self.q_gram_cache.info(), 'sim_cache': self.sim_cache.info()}
+
+    def sim_block(self, strings_a: Sequence[str], strings_b: Sequence[str], threshold: float, cache: bool = False):
+        """Calculate the similarity of all pairs of strings of two parties in a block and return the pairs with a
+           similarity of at least threshold, which must be positive.
 
+           The intersection counts of all pairs are computed at once as the product of the sparse binary string by
+           q-gram matrices. The similarities are identical to the ones of sim.
+
+           :return: A 3-tuple of arrays of equal length containing
+               the position in strings_a of every pair
+               the position in strings_b of every pair
+               the similarity of every pair
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError('Threshold must be in (0, 1], got {}'.format(threshold))
+        if len(strings_a) == 0 or len(strings_b) == 0:
+            no_pairs = np.empty(0, dtype=np.int64)
+            return no_pairs, no_pairs, np.empty(0)
+        q_minus_1 = self.ngram_len - 1
+        vocabulary = {}  # type: Dict[str, int]
+        recs_a, grams_a, lengths_a = self._qgram_matrix(strings_a, q_minus_1, cache, vocabulary)
+        recs_b, grams_b, lengths_b = self._qgram_matrix(strings_b, q_minus_1, cache, vocabulary)
+
+        # postings of party b: the records containing each q-gram are recs_b[offsets[g]:offsets[g + 1]]
+        order = np.argsort(grams_b, kind='stable')
+        recs_b = recs_b[order]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(grams_b, minlength=len(vocabulary)))))
+        # expand every q-gram of party a to all records of party b sharing it
+        counts = offsets[grams_a + 1] - offsets[grams_a]
+        pair_a = np.repeat(recs_a, counts)
+        ends = np.cumsum(counts)
+        num_entries = int(ends[-1]) if len(ends) else 0
+        pair_b = recs_b[np.arange(num_entries) - np.repeat(ends - counts - offsets[grams_a], counts)]
+        codes, common = np.unique(pair_a * len(strings_b) + pair_b, return_counts=True)
+        pair_a, pair_b = np.divmod(codes, len(strings_b))
+        sims = 2.0 * common / (lengths_a[pair_a] + lengths_b[pair_b])
+
+        # equal strings have similarity 1.0, even if they have repeated or no q-grams
+        positions_b = defaultdict(list)  # type: Dict[str, List[int]]
+        for j, string in enumerate(strings_b):
+            positions_b[string].append(j)
+        equal_pairs = [i * len(strings_b) + j
+                       for i, string in enumerate(strings_a) for j in positions_b.get(string, ())]
+        if equal_pairs:
+            equal_codes = np.array(equal_pairs, dtype=np.int64)
+            sims[np.isin(codes, equal_codes)] = 1.0
+            missing = np.setdiff1d(equal_codes, codes)
+            codes = np.concatenate((codes, missing))
+            sims = np.concatenate((sims, np.ones(len(missing))))
+            order = np.argsort(codes)
+            codes, sims = codes[order], sims[order]
+            pair_a, pair_b = np.divmod(codes, len(strings_b))
+
+        selected = sims >= threshold
+        return pair_a[selected], pair_b[selected], sims[selected]
+
+    def iter_block_sims(self, blocks: Iterable[Tuple[Any, Sequence[Sequence[Any]]]],
+                        strings: Sequence[Any], threshold: float, cache: bool = False):
+        """Calculate the similarities of the pairs of records of two parties one block at a time.
+
+           :param blocks: iterable of (block_key, [record IDs of party a, record IDs of party b]) as returned by
+               blocks_generator.iter_blocks
+           :param strings: for each party, the string of each record, indexed by record ID
+           :param threshold: minimum similarity of the returned pairs, must be positive
+           :return: generator of (block_key, record IDs of party a, record IDs of party b, similarities) for the
+               pairs of each block with a similarity of at least threshold
+        """
+        strings_a, strings_b = strings
+        for block_key, (recs_a, recs_b) in blocks:
+            pos_a, pos_b, sims = self.sim_block([strings_a[rec] for rec in recs_a], [strings_b[rec] for rec in recs_b],
+                                                threshold, cache)
+            yield block_key, [recs_a[i] for i in pos_a.tolist()], [recs_b[j] for j in pos_b.tolist()], sims
+
+    def _qgram_matrix(self, strings: Sequence[str], q_minus_1: int, cache: bool, vocabulary: Dict[str, int]):
+        """Return the sparse string by q-gram matrix as (string position, q-gram id) entries and the number of
+           q-grams of every string. New q-grams are added to vocabulary."""
+        recs = []  # type: List[int]
+        grams = []  # type: List[int]
+        lengths = np.empty(len(strings), dtype=np.int64)
+        for i, string in enumerate(strings):
+            qgram_set, lengths[i] = self._convert_to_qgrams(string, q_minus_1, cache)
+            recs.extend([i] * len(qgram_set))
+            grams.extend(vocabulary.setdefault(gram, len(vocabulary)) for gram in qgram_set)
+        return np.array(recs, dtype=np.int64), np.array(grams, dtype=np.int64), lengths
+
+    def _convert_to_qgrams(self, inputstr: str, q_minus_1: int, cache: bool) -> Tuple[FrozenSet[str], int]:
+        if cache:
+            qgrams = self.q_gram_cache.get(inputstr)
+            if qgrams is not None:
+                return qgrams
+
+        # Need to calculate q-gram list for the first string
+        if self.ngram_padding:
+            ps1 = self.padding_start_char * q_minus_1 + inputstr + self.padding_end_char * q_minus_1
         else:
-            # Need to calculate q-gram list for the first string
-            if self.ngram_padding:
-                ps1 = self.padding_start_char * q_minus_1 + inputstr + self.padding_end_char * q_minus_1
-            else:
-                ps1 = inputstr
+            ps1 = inputstr
 
-            qgrams = [ps1[i:i + self.ngram_len] for i in range(len(ps1) - q_minus_1)]
+        q_gram_list = [ps1[i:i + self.ngram_len] for i in range(len(ps1) - q_minus_1)]
+        qgrams = (frozenset(q_gram_list), len(q_gram_list))
 
-            if cache:
-                self.q_gram_cache[inputstr] = qgrams
+        if cache:
+            self.q_gram_cache.put(inputstr, qgrams)
         return qgrams
 
+
+def _shared_dice_cache(key: Tuple, maxsize: Optional[Any]) -> LRUCache:
+    """Return the shared cache for key, creating it or growing it to maxsize if given.
+
+    A shared cache is never shrunk, so creating an instance doesn't evict the entries of other instances.
+    """
+    with _SHARED_DICE_CACHES_LOCK:
+        shared_cache = _SHARED_DICE_CACHES.get(key)
+        if shared_cache is None:
+            shared_cache = _SHARED_DICE_CACHES[key] = LRUCache(
+                DEFAULT_DICE_CACHE_SIZE if maxsize is None else int(maxsize))
+        elif maxsize is not None and int(maxsize) > shared_cache.maxsize:
+            shared_cache.resize(int(maxsize))
+        return shared_cache
@@ -1,5 +1,14 @@
-import statistics
-from typing import Sequence, Dict, List, Any
+from collections import Counter, defaultdict
+import heapq
+import itertools
+import math
+import operator
+import random
+from typing import Sequence, Dict, List, Any, Optional, Set, Tuple
+import numpy as np
+
+# percentiles of the block sizes reported by summarize_blocks
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
 
 
 def reversed_index_per_strategy_stats(reversed_index_per_strategy: Sequence[Dict[str, List[Any]]], num_elements: int):
@@ -19,14 +28,144 @@ def _add_coverage_to_stats_per_stragegy(stats: Dict, num_elements: int):
 
 
 def reversed_index_stats(reversed_index: Dict[str, List[Any]]):
-    lengths = [len(rv) for rv in reversed_index.values()]
-    stats = {
-        'num_of_blocks': len(lengths),
-        'min_size': 0 if len(lengths) == 0 else min(lengths),
-        'max_size': 0 if len(lengths) == 0 else max(lengths),
-        'avg_size': 0 if len(lengths) == 0 else statistics.mean(lengths),
-        'med_size': 0 if len(lengths) == 0 else int(statistics.median(lengths)),
-        'std_size': 0 if 0 <= len(lengths) <= 1 else statistics.stdev(lengths),
-        'sum_of_blocks': sum(lengths)
+    lengths = np.fromiter((len(rv) for rv in reversed_index.values()), dtype=np.int64, count=len(reversed_index))
+    return block_size_stats(lengths)
+
+
+def block_size_stats(lengths: np.ndarray) -> Dict[str, Any]:
+    """Return count, minimum, maximum, mean, median, sample standard deviation and sum of the block sizes."""
+    n = len(lengths)
+    if n == 0:
+        return {'num_of_blocks': 0, 'min_size': 0, 'max_size': 0, 'avg_size': 0, 'med_size': 0, 'std_size': 0,
+                'sum_of_blocks': 0}
+    total = int(lengths.sum())
+    # the variance is computed from exact integer sums
+    sum_of_squares = int(np.dot(lengths, lengths))
+    return {
+        'num_of_blocks': n,
+        'min_size': int(lengths.min()),
+        'max_size': int(lengths.max()),
+        'avg_size': total / n,
+        'med_size': int(np.median(lengths)),
+        'std_size': 0 if n == 1 else math.sqrt((n * sum_of_squares - total * total) / (n * (n - 1))),
+        'sum_of_blocks': total
+    }
+
+
+def block_size_distribution(lengths: np.ndarray, percentiles: Sequence[float] = DEFAULT_PERCENTILES):
+    """Return percentiles of the block sizes and their histogram with bins [0, 1), [1, 2), [2, 4), [4, 8), ..."""
+    if len(lengths) == 0:
+        return {'size_percentiles': {p: 0.0 for p in percentiles}, 'size_histogram': {'bin_edges': [], 'counts': []}}
+    bin_edges = np.concatenate(([0], 2 ** np.arange(int(lengths.max()).bit_length() + 1)))
+    counts, _ = np.histogram(lengths, bins=bin_edges)
+    return {
+        'size_percentiles': dict(zip(percentiles, np.percentile(lengths, percentiles).tolist())),
+        'size_histogram': {'bin_edges': bin_edges.tolist(), 'counts': counts.tolist()},
     }
+
+
+def num_of_blocks_per_record(reversed_index: Dict[Any, Sequence[Any]]) -> np.ndarray:
+    """Return the number of blocks of every record in the reversed index, in no particular order."""
+    num_memberships = sum(len(recs) for recs in reversed_index.values())
+    try:
+        # operator.index only accepts integers, so that e.g. '1' and '01' or 1.5 and 1.0 aren't converted
+        records = np.fromiter(map(operator.index, itertools.chain.from_iterable(reversed_index.values())),
+                              dtype=np.int64, count=num_memberships)
+    except (TypeError, ValueError, OverflowError):
+        # count record IDs which aren't integers as they are
+        return np.fromiter(Counter(itertools.chain.from_iterable(reversed_index.values())).values(),
+                           dtype=np.int64)
+    if num_memberships and 0 <= records.min() and records.max() < 4 * num_memberships:
+        counts = np.bincount(records)
+        return counts[counts > 0]
+    return np.unique(records, return_counts=True)[1]
+
+
+def summarize_blocks(reversed_index: Dict[Any, Sequence[Any]]) -> Dict[str, Any]:
+    """Return the block size statistics and distribution, and the number of blocks of every record."""
+    lengths = np.fromiter((len(recs) for recs in reversed_index.values()), dtype=np.int64, count=len(reversed_index))
+    stats = block_size_stats(lengths)
+    stats.update(block_size_distribution(lengths))
+    stats['num_of_blocks_per_rec'] = num_of_blocks_per_record(reversed_index).tolist()
     return stats
+
+
+def block_comparisons(sizes: Sequence[int]) -> int:
+    """Return the number of record pairs across parties in a block, given the block size of each party."""
+    total = sum(sizes)
+    return (total * total - sum(size * size for size in sizes)) // 2
+
+
+def estimate_candidate_pairs(blocks: Sequence[Any], top_n: int = 10, num_samples: int = 10000,
+                             random_state: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Estimate the number of record pairs that will be compared across parties, without enumerating the pairs.
+
+    The number of comparisons of a block is the sum over all pairs of parties of the product of their block sizes,
+    counting a record listed several times in a block of a party once.
+    Their sum is an upper bound of the number of candidate pairs, which counts a pair once for every block it
+    shares. The number of distinct candidate pairs is estimated by sampling pairs proportionally to the number of
+    comparisons of each block and weighting each by the inverse of the number of blocks it occurs in (Karp-Luby).
+
+    :param blocks: for each party, either a CandidateBlockingResult or a dict mapping block keys to record IDs,
+        e.g. the output of generate_blocks
+    :param top_n: number of most expensive blocks to report
+    :param num_samples: number of sampled pairs to estimate the number of distinct candidate pairs
+    :param random_state: seed of the pair sampling
+    :return: dict with
+        num_block_pairs: the number of comparisons summed over all blocks
+        est_distinct_pairs: the estimated number of distinct candidate pairs
+        top_blocks: list of (block key, number of comparisons) of the top_n most expensive blocks
+    """
+    reversed_indices = [getattr(obj, 'blocks', obj) for obj in blocks]
+    costs = {}  # type: Dict[Any, int]
+    # iterate the keys in first seen order, so that sampling and ties of top_blocks are reproducible
+    for key in dict.fromkeys(itertools.chain.from_iterable(reversed_indices)):
+        cost = block_comparisons([len(set(reversed_index.get(key, ()))) for reversed_index in reversed_indices])
+        if cost > 0:
+            costs[key] = cost
+
+    num_block_pairs = sum(costs.values())
+    top_blocks = heapq.nlargest(top_n, costs.items(), key=operator.itemgetter(1))
+    if num_block_pairs == 0 or num_samples < 1:
+        est_distinct_pairs = float(num_block_pairs)
+    else:
+        est_distinct_pairs = _estimate_distinct_pairs(reversed_indices, costs, num_block_pairs, num_samples,
+                                                      random.Random(random_state))
+    return {
+        'num_block_pairs': num_block_pairs,
+        'est_distinct_pairs': est_distinct_pairs,
+        'top_blocks': top_blocks,
+    }
+
+
+def _estimate_distinct_pairs(reversed_indices: Sequence[Dict[Any, List[Any]]], costs: Dict[Any, int],
+                             num_block_pairs: int, num_samples: int, rng: random.Random) -> float:
+    # blocks each record is in, only counting blocks shared with other parties
+    rec_to_blocks = []
+    for reversed_index in reversed_indices:
+        map_rec_block = defaultdict(set)  # type: Dict[Any, Set[Any]]
+        for key, recs in reversed_index.items():
+            if key in costs:
+                for rec in recs:
+                    map_rec_block[rec].add(key)
+        rec_to_blocks.append(map_rec_block)
+
+    # the distinct records of each sampled block, so that every pair of a block is sampled with equal probability
+    distinct_blocks = {}  # type: Dict[Any, List[Tuple[int, List[Any]]]]
+    keys = list(costs)
+    sampled_keys = rng.choices(keys, cum_weights=list(itertools.accumulate(costs[key] for key in keys)),
+                               k=num_samples)
+    sum_of_weights = 0.0
+    for key in sampled_keys:
+        if key not in distinct_blocks:
+            distinct_blocks[key] = [(party, list(dict.fromkeys(reversed_index[key])))
+                                    for party, reversed_index in enumerate(reversed_indices) if reversed_index.get(key)]
+        block = distinct_blocks[key]
+        party_pairs = list(itertools.combinations(block, 2))
+        (party_a, recs_a), (party_b, recs_b) = rng.choices(
+            party_pairs, weights=[len(recs_a) * len(recs_b) for (_, recs_a), (_, recs_b) in party_pairs])[0]
+        rec_a, rec_b = rng.choice(recs_a), rng.choice(recs_b)
+        # the sampled pair is compared in every block both records are in
+        sum_of_weights += 1.0 / len(rec_to_blocks[party_a][rec_a] & rec_to_blocks[party_b][rec_b])
+    return num_block_pairs * sum_of_weights / num_samples
@@ -1,6 +1,9 @@
 import base64
+import binascii
+import os
+import numpy as np
 from bitarray import bitarray
-from typing import Sequence, Any, List
+from typing import Sequence, Any, List, Optional
 
 
 def check_header(header: List[str], row: Sequence[Any]):
@@ -23,3 +26,54 @@ def deserialize_filters(filters: Sequence[Any]):
         res.append(ba)
     return res
 
+
+def _filter_to_bytes(filter_data: Any):
+    """Return the raw bytes of a filter, base64 decoding it if it is a string."""
+    if isinstance(filter_data, str):
+        return binascii.a2b_base64(filter_data)
+    return memoryview(filter_data).cast('B')
+
+
+def deserialize_filters_to_array(filters: Sequence[Any]):
+    """Decode all filters into one contiguous array.
+
+    :param filters: filters of equal length, either base64 encoded strings or raw bytes-like objects
+    :return: clks: np.uint8 array of shape (number of filters, bytes per filter) with packed bits,
+        most significant bit first
+    """
+    if len(filters) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+
+    num_bytes = len(_filter_to_bytes(filters[0]))
+    buffer = bytearray(len(filters) * num_bytes)
+    view = memoryview(buffer)
+    for i, f in enumerate(filters):
+        data = _filter_to_bytes(f)
+        if len(data) != num_bytes:
+            raise ValueError('All filters must have the same length, but filter {} has {} bytes instead of {}'
+                             .format(i, len(data), num_bytes))
+        view[i * num_bytes: (i + 1) * num_bytes] = data
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(len(filters), num_bytes)
+
+
+def load_clk_file(path: str, bytes_per_clk: Optional[int] = None):
+    """Memory map a binary file of fixed width CLKs.
+
+    :param path: either a ``.npy`` file holding a 2-D np.uint8 array, or a file of concatenated raw CLKs
+    :param bytes_per_clk: length of each CLK in bytes, required for raw files
+    :return: clks: read-only np.uint8 memory map of shape (number of CLKs, bytes per CLK)
+    """
+    if path.endswith('.npy'):
+        clks = np.load(path, mmap_mode='r')
+        if clks.ndim != 2 or clks.dtype != np.uint8:
+            raise ValueError('Expected a 2-D uint8 array in {}, got {} array of shape {}'
+                             .format(path, clks.dtype, clks.shape))
+        return clks
+
+    if not bytes_per_clk:
+        raise ValueError('The CLK length is required to read the raw CLK file {}'.format(path))
+    file_size = os.path.getsize(path)
+    if file_size == 0 or file_size % bytes_per_clk != 0:
+        raise ValueError('Size of {} ({} bytes) is not a multiple of the CLK length of {} bytes'
+                         .format(path, file_size, bytes_per_clk))
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=(file_size // bytes_per_clk, bytes_per_clk))
@@ -1,6 +1,8 @@
 import pytest
-from blocklib import generate_blocks, generate_reverse_blocks
+from blocklib import generate_blocks, generate_reverse_blocks, iter_blocks, split_oversized_blocks
 from blocklib import generate_candidate_blocks, flip_bloom_filter
+from blocklib.blocks_generator import select_common_block_keys, filter_reversed_index
+from blocklib.encoding import positions_to_block_key
 
 
 class TestBlocksGenerator:
@@ -23,6 +25,19 @@ class TestBlocksGenerator:
         assert record_to_blocks[0] == {'r1': {'Fr'}, 'r2': {'Fr'}, 'r3': {'Jo'}, 'r4': {'Jo'}}
         assert record_to_blocks[1] == {1: {'Li'}, 2: {'Li', 'Xu'}, 3: {'Li', 'Xu'}, 4: {'Xu'}}
 
+    def test_select_common_block_keys(self):
+        """Test K-of-P join of block keys."""
+        reversed_indices = [
+            {'a': [1], 'b': [2], 'c': [3]},
+            {'b': [4], 'c': [5], 'd': [6]},
+            {'c': [7], 'd': [8], 'e': [9]},
+        ]
+        assert select_common_block_keys(reversed_indices, 2) == {'b', 'c', 'd'}
+        assert select_common_block_keys(reversed_indices, 3) == {'c'}
+        filtered = filter_reversed_index(reversed_indices[1], {'d', 'b'})
+        assert list(filtered.items()) == [('b', [4]), ('d', [6])]
+        assert filtered['b'] is reversed_indices[1]['b']
+
     def test_lambdafold(self):
         """Test block generator for PPRLLambdaFold method."""
         config = {
@@ -55,6 +70,98 @@ class TestBlocksGenerator:
         assert list(filtered_alice.values()) == [['id1'], ['id1'], ['id1'], ['id1'], ['id1']]
         assert list(filtered_bob.values()) == [['id3'], ['id3'], ['id3'], ['id3'], ['id3']]
 
+    def test_split_oversized_blocks_lambdafold(self):
+        """Test splitting oversized Lambda-fold blocks by additional bits."""
+        config = {
+            "blocking-features": [1, 2],
+            "Lambda": 3,
+            "bf-len": 256,
+            "num-hash-funcs": 10,
+            "K": 1,
+            "split-bits": 40,
+            "random_state": 0,
+            "record-id-col": 0,
+            "input-clks": False
+        }
+        blocking_config = {'type': 'lambda-fold', 'version': 1, 'config': config}
+        records_alice = [['id1', "Joyce", "Wang"], ['id2', "Fred", "Yu"], ['id3', "Lindsay", "Lin"]]
+        records_bob = [['id4', "Joyce", "Wang"], ['id5', "Fred", "Zhang"], ['id6', "Li", "Jone"]]
+        candidate_objs = [generate_candidate_blocks(records_alice, blocking_config),
+                          generate_candidate_blocks(records_bob, blocking_config)]
+
+        split_objs = split_oversized_blocks(candidate_objs, [records_alice, records_bob], max_block_size=1)
+        assert [obj.state for obj in split_objs] == [obj.state for obj in candidate_objs]
+        for obj, split_obj in zip(candidate_objs, split_objs):
+            # every record stays in one block per table
+            assert sorted(sum(obj.blocks.values(), [])) == sorted(sum(split_obj.blocks.values(), []))
+            assert max(len(recs) for recs in split_obj.blocks.values()) == 1
+            assert any(len(key) == 3 for key in split_obj.blocks)
+
+        filtered_alice, filtered_bob = generate_blocks(split_objs, K=2)
+        # the identical records still share a sub-block in every table
+        shared_tables = {key[0] for key in filtered_alice
+                         if filtered_alice[key] == ['id1'] and filtered_bob[key] == ['id4']}
+        assert shared_tables == set(range(config['Lambda']))
+
+    def test_split_oversized_blocks_duplicates(self):
+        """Test splitting stops once a level divides no block."""
+        config = {
+            "blocking-features": [1, 2],
+            "Lambda": 2,
+            "bf-len": 256,
+            "num-hash-funcs": 10,
+            "K": 1,
+            "random_state": 0,
+            "record-id-col": 0,
+            "input-clks": False
+        }
+        blocking_config = {'type': 'lambda-fold', 'version': 1, 'config': config}
+        records_alice = [['id{}'.format(i), "Joyce", "Wang"] for i in range(4)]
+        records_bob = [['id{}'.format(i), "Joyce", "Wang"] for i in range(4, 6)]
+        candidate_objs = [generate_candidate_blocks(records_alice, blocking_config),
+                          generate_candidate_blocks(records_bob, blocking_config)]
+        split_calls = []
+        for obj in candidate_objs:
+            split_blocks = obj.state.split_blocks
+
+            def counting_split_blocks(*args, split_blocks=split_blocks):
+                split_calls.append(args[3])
+                return split_blocks(*args)
+            obj.state.split_blocks = counting_split_blocks
+
+        split_objs = split_oversized_blocks(candidate_objs, [records_alice, records_bob], max_block_size=1)
+        # duplicate records can't be divided, so only the first level is tried and the blocks are unchanged
+        assert split_calls == [0, 0]
+        assert [obj.blocks for obj in split_objs] == [obj.blocks for obj in candidate_objs]
+
+    def test_split_oversized_blocks_psig(self):
+        """Test splitting oversized P-Sig blocks by a secondary signature strategy."""
+        data1 = [('id1', 'Fred', 'Yu'), ('id2', 'Fred', 'Zhang'), ('id3', 'Fred', 'Li'), ('id4', 'Joyce', 'Wang')]
+        data2 = [('id5', 'Fred', 'Yu'), ('id6', 'Fred', 'Zhang'), ('id7', 'Joyce', 'Hsu')]
+        config = {
+            "blocking-features": [1, 2],
+            "filter": {"type": "count", "max": 5, "min": 0},
+            "blocking-filter": {"type": "bloom filter", "number-hash-functions": 20, "bf-len": 2048},
+            "signatureSpecs": [[{"type": "feature-value", "feature": 1}]],
+            "split-signatureSpecs": [[{"type": "feature-value", "feature": 2}]],
+            "record-id-col": 0,
+        }
+        blocking_config = {'type': 'p-sig', 'version': 1, 'config': config}
+        candidate_objs = [generate_candidate_blocks(data1, blocking_config),
+                          generate_candidate_blocks(data2, blocking_config)]
+
+        # only the Fred block has more than 2 record pairs
+        split_objs = split_oversized_blocks(candidate_objs, [data1, data2], max_pairs=2)
+        filtered_alice, filtered_bob = generate_blocks(split_objs, K=2)
+        assert sorted(filtered_alice.values()) == [['id1'], ['id2'], ['id4']]
+        assert sorted(filtered_bob.values()) == [['id5'], ['id6'], ['id7']]
+        # the Joyce block is not split
+        joyce_key = positions_to_block_key(sorted(flip_bloom_filter('0_Joyce', 2048, 20)))
+        assert filtered_alice[joyce_key] == ['id4']
+
+        with pytest.raises(ValueError):
+            split_oversized_blocks(candidate_objs, [data1, data2])
+
     def test_psig(self):
         """Test block generator for PPRLPsig method."""
         data1 = [('id1', 'Joyce', 'Wang', 'Ashfield'),
@@ -107,7 +214,7 @@ class TestBlocksGenerator:
         for string in ['1_Fr', '0_Fred', '1_Li']:
             bf_set = flip_bloom_filter(string, config['blocking-filter']['bf-len'],
                                        config['blocking-filter']['number-hash-functions'])
-            expected_bf_sets[str(tuple(bf_set))] = True
+            expected_bf_sets[positions_to_block_key(sorted(bf_set))] = True
 
         assert all(key in expected_bf_sets for key in filtered_alice)
         assert filtered_alice.keys() == filtered_bob.keys()
@@ -170,14 +277,17 @@ class TestBlocksGenerator:
             candidate_obj_m1, candidate_obj_m2, candidate_obj_m3, candidate_obj_m4
         ]
         # blocks generator
+        candidate_blocks = [dict(obj.blocks) for obj in candidate_objs]
         filtered_records = generate_blocks(candidate_objs, K=3)
         filtered_m1, filtered_m2, filtered_m3, filtered_m4 = filtered_records
+        # candidate blocks are left untouched
+        assert [obj.blocks for obj in candidate_objs] == candidate_blocks
 
         expected_bf_sets = {}
         for string in ['1_Fr', '1_Jo']:
             bf_set = flip_bloom_filter(string, config['blocking-filter']['bf-len'],
                                        config['blocking-filter']['number-hash-functions'])
-            expected_bf_sets[string] = str(tuple(bf_set))
+            expected_bf_sets[string] = positions_to_block_key(sorted(bf_set))
 
         expected_m1 = {expected_bf_sets['1_Fr']: ['m1-2'], expected_bf_sets['1_Jo']: ['m1-1']}
         expected_m2 = {expected_bf_sets['1_Fr']: ['m2-1'], expected_bf_sets['1_Jo']: ['m2-2']}
@@ -189,4 +299,11 @@ class TestBlocksGenerator:
         assert expected_m3 == filtered_m3
         assert expected_m4 == filtered_m4
 
+        # streaming the final blocks gives the same blocks without copying them
+        streamed_blocks = dict(iter_blocks(candidate_objs, K=3))
+        assert streamed_blocks.keys() == filtered_m1.keys() | filtered_m2.keys() | filtered_m3.keys()
+        for block_key, record_ids in streamed_blocks.items():
+            assert record_ids == [filtered.get(block_key, []) for filtered in filtered_records]
+            assert all(recs is obj.blocks[block_key] for recs, obj in zip(record_ids, candidate_objs) if recs)
+
 
@@ -3,6 +3,7 @@ import pytest
 from blocklib import generate_candidate_blocks
 from blocklib import PPRLIndexPSignature
 from blocklib import flip_bloom_filter
+from blocklib.encoding import positions_to_block_key
 
 data = [('id1', 'Joyce', 'Wang', 'Ashfield'),
         ('id2', 'Joyce', 'Hsu', 'Burwood'),
@@ -71,6 +72,16 @@ class TestCandidateBlockGenerator:
                         'version': 1,
                         'config': config}
         candidate_block_obj = generate_candidate_blocks(data, block_config)
-        bf_set_fred = str(tuple(flip_bloom_filter('0_Fred', bf_len, num_hash_funcs)))
-        bf_set_lindsay = str(tuple(flip_bloom_filter('0_Lindsay', bf_len, num_hash_funcs)))
+        bf_set_fred = positions_to_block_key(sorted(flip_bloom_filter('0_Fred', bf_len, num_hash_funcs)))
+        bf_set_lindsay = positions_to_block_key(sorted(flip_bloom_filter('0_Lindsay', bf_len, num_hash_funcs)))
         assert candidate_block_obj.blocks == {bf_set_fred: ['id4', 'id5'], bf_set_lindsay: ['id6']}
+
+        # statistics can be skipped or computed on first access
+        assert candidate_block_obj.state.stats['num_of_blocks'] == 2
+        assert generate_candidate_blocks(data, block_config, stats=False).state.stats == {}
+        lazy_state = generate_candidate_blocks(data, block_config, stats='lazy').state
+        assert lazy_state._deferred_reversed_index is not None
+        assert lazy_state.stats == candidate_block_obj.state.stats
+        assert lazy_state._deferred_reversed_index is None
+        with pytest.raises(ValueError):
+            generate_candidate_blocks(data, block_config, stats='later')
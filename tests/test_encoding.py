@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+import pytest
+
+from blocklib.cache import LRUCache
+from blocklib.encoding import (BIT_POSITION_CACHE, bit_positions, block_key_to_positions, flip_bloom_filter,
+                               generate_bloom_filter, positions_to_block_key)
+
+
+def test_lru_cache():
+    """Test eviction order and counters of the LRU cache."""
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts 'b', the least recently used entry
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.info() == {'hits': 1, 'misses': 1, 'evictions': 1, 'hit_rate': 0.5, 'size': 2, 'maxsize': 2}
+
+    cache.resize(1)
+    assert len(cache) == 1 and 'c' in cache
+    assert cache.evictions == 2
+    assert cache.get_or_compute('d', lambda: 4) == 4
+    assert cache.get_or_compute('d', lambda: 5) == 4
+
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=-1)
+
+
+def test_lru_cache_threads():
+    """Test the counters stay consistent when the cache is used from several threads."""
+    cache = LRUCache(maxsize=10)
+
+    def work(offset):
+        for i in range(1000):
+            cache.get_or_compute((i + offset) % 20, lambda: i)
+
+    threads = [threading.Thread(target=work, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = cache.info()
+    assert info['hits'] + info['misses'] == 4000
+    assert info['size'] == 10
+    assert info['evictions'] == info['misses'] - 10
+
+
+def test_bit_positions_cache():
+    """Test cached bit positions agree with the flipped bloom filter bits."""
+    BIT_POSITION_CACHE.clear()
+    positions = bit_positions('Jo', 2048, 20)
+    assert positions.dtype == np.uint32
+    assert list(positions) == sorted(flip_bloom_filter('Jo', 2048, 20))
+    assert BIT_POSITION_CACHE.hits == 1 and BIT_POSITION_CACHE.misses == 1
+    # the cached array is shared and must not be modified by callers
+    with pytest.raises(ValueError):
+        positions[0] = 0
+
+    bloom_filter = generate_bloom_filter(['Jo', 'oy'], 2048, 20)
+    assert set(np.flatnonzero(bloom_filter)) == flip_bloom_filter('Jo', 2048, 20) | flip_bloom_filter('oy', 2048, 20)
+
+
+def test_block_key_round_trip():
+    """Test P-Sig block keys are the little-endian uint32 bytes of the bit positions."""
+    positions = bit_positions('Jo', 2048, 20)
+    block_key = positions_to_block_key(positions)
+    assert block_key == b''.join(int(position).to_bytes(4, 'little') for position in positions)
+    assert block_key_to_positions(block_key).tolist() == positions.tolist()
+    assert positions_to_block_key(sorted(flip_bloom_filter('Jo', 2048, 20))) == block_key
@@ -1,4 +1,5 @@
-from blocklib import assess_blocks_2party, generate_blocks, generate_candidate_blocks
+from blocklib import assess_blocks_2party, assess_blocks_multiparty, estimate_blocks_2party, generate_blocks, generate_candidate_blocks
+import numpy as np
 import pytest
 
 
@@ -69,3 +70,70 @@ def test_assess_blocks_2party():
 
     with pytest.raises(ValueError):
         assess_blocks_2party([{}, {}], [[], []])
+
+
+@pytest.mark.parametrize('max_memory', [2**28, 1000])
+def test_assess_blocks_2party_duplicate_pairs(max_memory):
+    """Pairs of entities are only counted once, even if they share several blocks or occur twice."""
+    rng = np.random.RandomState(1)
+    dp1_data = rng.choice(['e{}'.format(i) for i in range(40)], size=60).tolist()
+    dp2_data = rng.choice(['e{}'.format(i) for i in range(20, 60)], size=50).tolist()
+    blocks = [{key: rng.choice(len(dp_data), size=rng.randint(1, 8)).tolist() for key in keys}
+              for dp_data, keys in [(dp1_data, range(0, 30)), (dp2_data, range(15, 45))]]
+
+    cand_pairs = {(dp1_data[r1], dp2_data[r2])
+                  for key in blocks[0].keys() & blocks[1].keys()
+                  for r1 in blocks[0][key] for r2 in blocks[1][key]}
+    num_true_matches = sum(e1 == e2 for e1, e2 in cand_pairs)
+    expected_rr = 1.0 - float(len(cand_pairs)) / (len(dp1_data) * len(dp2_data))
+    expected_pc = float(num_true_matches) / len(set(dp1_data) & set(dp2_data))
+
+    rr, pc = assess_blocks_2party(blocks, [dp1_data, dp2_data], max_memory=max_memory)
+    assert rr == expected_rr
+    assert pc == expected_pc
+
+
+def test_estimate_blocks_2party():
+    """Sampled rr and pc agree with the exact assessment."""
+    rng = np.random.RandomState(2)
+    dp1_data = ['e{}'.format(i) for i in range(300)]
+    dp2_data = ['e{}'.format(i) for i in range(150, 400)]
+    blocks = [{key: rng.choice(len(dp_data), size=rng.randint(1, 20), replace=False).tolist() for key in range(100)}
+              for dp_data in (dp1_data, dp2_data)]
+    rr, pc = assess_blocks_2party(blocks, [dp1_data, dp2_data])
+
+    estimate = estimate_blocks_2party(blocks, [dp1_data, dp2_data], num_samples=2000, random_state=0)
+    assert estimate['num_pair_samples'] == 2000
+    assert estimate['rr_interval'][0] <= rr <= estimate['rr_interval'][1]
+    assert estimate['rr_interval'][0] <= estimate['rr'] <= estimate['rr_interval'][1]
+    # all 150 true matches are sampled
+    assert estimate['num_match_samples'] == 150
+    assert estimate['pc'] == pc
+    assert estimate['pc_interval'] == (pc, pc)
+
+    estimate = estimate_blocks_2party(blocks, [dp1_data, dp2_data], num_samples=100, random_state=0)
+    assert estimate['pc_interval'][0] <= pc <= estimate['pc_interval'][1]
+    assert estimate == estimate_blocks_2party(blocks, [dp1_data, dp2_data], num_samples=100, random_state=0)
+
+
+def test_assess_blocks_multiparty():
+    """Party pairs match the 2-party assessment, K-subsets count entities found in one block."""
+    data = [['a', 'b', 'c', 'd'], ['b', 'c', 'a'], ['c', 'e', 'a', 'b'], ['x']]
+    blocks = [{'k1': [0, 1], 'k2': [2], 'k3': [3]},
+              {'k1': [0, 2], 'k2': [1], 'k4': [0]},
+              {'k1': [3], 'k2': [0, 2], 'k3': [1]},
+              {'k3': [0]}]
+    result = assess_blocks_multiparty(blocks, data, K=3)
+
+    assert set(result['pairs']) == {(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)}
+    for (i, j), assessment in result['pairs'].items():
+        rr, pc = assess_blocks_2party([blocks[i], blocks[j]], [data[i], data[j]])
+        assert assessment == {'rr': rr, 'pc': pc}
+
+    # b and c, but not a, are in one block of parties 0, 1 and 2
+    assert result['subsets'][(0, 1, 2)]['pc'] == 2 / 3
+    assert result['subsets'][(0, 1, 2)]['rr'] == 1 - (2 * 2 * 1 + 1 * 1 * 2) / (4 * 3 * 4)
+    assert result['subsets'][(0, 1, 3)] == {'rr': 1.0, 'pc': 0.0}
+
+    with pytest.raises(ValueError):
+        assess_blocks_multiparty(blocks, data, K=5)
@@ -0,0 +1,67 @@
+import itertools
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from blocklib import candidate_pairs, iter_candidate_pairs
+from blocklib.pairs import DEFAULT_MAX_MEMORY
+
+
+def expected_pairs(reversed_index_a, reversed_index_b):
+    pairs = set()
+    for key, recs_a in reversed_index_a.items():
+        pairs.update(itertools.product(recs_a, reversed_index_b.get(key, [])))
+    return pairs
+
+
+class TestCandidatePairs:
+
+    def setup_method(self):
+        rng = np.random.RandomState(0)
+        self.blocks_a = {key: sorted(rng.choice(50, size=rng.randint(1, 10), replace=False).tolist())
+                         for key in range(30)}
+        self.blocks_b = {key: sorted(rng.choice(40, size=rng.randint(1, 10), replace=False).tolist())
+                         for key in range(10, 40)}
+
+    @pytest.mark.parametrize('max_memory', [DEFAULT_MAX_MEMORY, 1000])
+    def test_unique_pairs(self, max_memory):
+        rec_a, rec_b = candidate_pairs([self.blocks_a, self.blocks_b], max_memory=max_memory)
+        assert rec_a.dtype == rec_b.dtype == np.int64
+        pairs = list(zip(rec_a.tolist(), rec_b.tolist()))
+        assert len(pairs) == len(set(pairs))
+        assert set(pairs) == expected_pairs(self.blocks_a, self.blocks_b)
+
+    def test_chunks(self):
+        chunks = list(iter_candidate_pairs([self.blocks_a, self.blocks_b], chunk_size=7, max_memory=1000))
+        assert all(len(a) == len(b) == 7 for a, b in chunks[:-1])
+        assert 0 < len(chunks[-1][0]) <= 7
+        num_pairs = sum(len(a) for a, _ in chunks)
+        assert num_pairs == len(expected_pairs(self.blocks_a, self.blocks_b))
+
+    def test_no_shared_blocks(self):
+        assert list(iter_candidate_pairs([{'a': [1]}, {'b': [2]}])) == []
+        rec_a, rec_b = candidate_pairs([{}, {}])
+        assert len(rec_a) == len(rec_b) == 0
+
+    def test_invalid_input(self):
+        with pytest.raises(ValueError):
+            list(iter_candidate_pairs([{'a': ['id1']}, {'a': ['id2']}]))
+        with pytest.raises(ValueError):
+            list(iter_candidate_pairs([{'a': [1]}, {'a': [2]}, {'a': [3]}]))
+        with pytest.raises(ValueError):
+            list(iter_candidate_pairs([{'a': [1]}, {'a': [2]}], chunk_size=0))
+
+    def test_memory_cap_single_record_blocks(self):
+        """One record sharing several huge blocks stays within the memory cap."""
+        recs_b = np.arange(250000, dtype=np.int64)
+        blocks = [{key: [0] for key in range(8)}, {key: recs_b for key in range(8)}]
+        max_memory = 2**20
+        tracemalloc.start()
+        try:
+            num_pairs = sum(len(rec_a) for rec_a, _ in iter_candidate_pairs(blocks, max_memory=max_memory))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert num_pairs == len(recs_b)
+        assert peak < 4 * max_memory
@@ -34,6 +34,25 @@ def test_summarize_reversed_index():
     num_of_blocks_per_rec.sort()
     assert num_of_blocks_per_rec == [1, 1, 1, 1, 2]
 
+    assert stats['size_percentiles'][50] == 2
+    assert stats['size_histogram'] == {'bin_edges': [0, 1, 2, 4], 'counts': [0, 1, 2]}
+
+    # integer record ids are counted with bincount
+    stats = pprl.summarize_reversed_index({'Jo': [0, 1, 2], 'Fr': [1, 30], 'Li': [4]})
+    assert sorted(stats['num_of_blocks_per_rec']) == [1, 1, 1, 1, 2]
+
+    # other record ids are counted as they are, without conversion to integers
+    stats = pprl.summarize_reversed_index({'a': ['1', '01'], 'b': ['1']})
+    assert sorted(stats['num_of_blocks_per_rec']) == [1, 2]
+    stats = pprl.summarize_reversed_index({'a': [1.5, 1.0], 'b': [1.0]})
+    assert sorted(stats['num_of_blocks_per_rec']) == [1, 2]
+    stats = pprl.summarize_reversed_index({'a': [1, '01'], 'b': [1]})
+    assert sorted(stats['num_of_blocks_per_rec']) == [1, 2]
+
+    # the summary can be deferred until stats are accessed
+    pprl.defer_summary(reversed_index)
+    assert pprl.stats['num_of_blocks'] == 3
+
 
 def test_select_reference_value():
     """Test selection of reference value."""
@@ -1,5 +1,11 @@
 import unittest
+import base64
 import json
+import os
+import random
+import tempfile
+from unittest import mock
+import numpy as np
 from pathlib import Path
 
 from blocklib import PPRLIndexLambdaFold
@@ -51,7 +57,7 @@ class TestLambdaFold(unittest.TestCase):
                 [2, 'Fred', 'Yu']]
         reversed_index = lambdafold.build_reversed_index(data)
         assert len(reversed_index) == 5 * 2
-        assert all([len(k) == 31 for k in reversed_index])
+        assert all([len(k) == 2 and 0 <= k[1] < 2 ** 30 for k in reversed_index])
         assert all([len(v) == 1 for v in reversed_index.values()])
 
         # build with row index
@@ -59,7 +65,7 @@ class TestLambdaFold(unittest.TestCase):
         lambdafold = PPRLIndexLambdaFold(config_index)
         reversed_index = lambdafold.build_reversed_index(data)
         assert len(reversed_index) == 5 * 2
-        assert all([len(k) == 31 for k in reversed_index])
+        assert all([len(k) == 2 and 0 <= k[1] < 2 ** 30 for k in reversed_index])
         assert all([len(v) == 1 for v in reversed_index.values()])
 
         # build given headers
@@ -76,7 +82,7 @@ class TestLambdaFold(unittest.TestCase):
         lambdafold_use_colname = PPRLIndexLambdaFold(config_name)
         reversed_index_use_colname = lambdafold_use_colname.build_reversed_index(data, header=header)
         assert len(reversed_index_use_colname) == 5 * 2
-        assert all([len(k) == 31 for k in reversed_index_use_colname])
+        assert all([len(k) == 2 and 0 <= k[1] < 2 ** 30 for k in reversed_index_use_colname])
         assert all([len(v) == 1 for v in reversed_index_use_colname.values()])
         assert reversed_index == reversed_index_use_colname
 
@@ -99,7 +105,99 @@ class TestLambdaFold(unittest.TestCase):
 
         reversed_index = lambdafold.build_reversed_index(data)
         assert len(reversed_index) == 5 * 4
-        assert all([len(k) == 31 for k in reversed_index])
+
+        # raw bytes give the same blocks as base64 encoded CLKs
+        raw_data = [base64.b64decode(clk) for clk in data]
+        assert lambdafold.build_reversed_index(raw_data).keys() == reversed_index.keys()
+        assert all([len(k) == 2 and 0 <= k[1] < 2 ** 30 for k in reversed_index])
+
+    def test_integer_keys_match_bit_strings(self):
+        """Test integer block keys group records the same way as the sampled bit strings."""
+        config = {
+            "blocking-features": [1, 2],
+            "Lambda": 5,
+            "bf-len": 64,
+            "record-id-col": 0,
+            "num-hash-funcs": 2,
+            "K": 4,
+            "random_state": 0,
+            "input-clks": False
+        }
+        lambdafold = PPRLIndexLambdaFold(config)
+        data = [['id1', 'Joyce', 'Wang'], ['id2', 'Joyce', 'Hsu'], ['id3', 'Fred', 'Yu'],
+                ['id4', 'Fred', 'Zhang'], ['id5', 'Joyce', 'Wang'], ['id6', 'Lindsay', 'Jone']]
+        reversed_index = lambdafold.build_reversed_index(data)
+
+        random.seed(config['random_state'])
+        expected = {}
+        for i in range(config['Lambda']):
+            indices = random.sample(range(config['bf-len']), config['K'])
+            for record in data:
+                clk = lambdafold.__record_to_bf__(record, config['blocking-features'])
+                block_key = ''.join(['1' if clk[ind] else '0' for ind in indices])
+                expected.setdefault((i, int(block_key, 2)), []).append(record[0])
+        assert reversed_index == expected
+        assert list(reversed_index) == list(expected)
+
+        with self.assertRaises(ValueError):
+            PPRLIndexLambdaFold(dict(config, K=65))
+
+    def test_build_reversed_index_workers(self):
+        """Test building the Lambda tables in a process pool gives the same index as a single process."""
+        config = {
+            "blocking-features": [1, 2],
+            "Lambda": 6,
+            "bf-len": 256,
+            "record-id-col": 0,
+            "num-hash-funcs": 5,
+            "K": 8,
+            "random_state": 0,
+            "input-clks": False
+        }
+        data = [['id{}'.format(i), first, last]
+                for i, (first, last) in enumerate([('Joyce', 'Wang'), ('Joyce', 'Hsu'), ('Fred', 'Yu'),
+                                                   ('Fred', 'Zhang'), ('Joyce', 'Wang'), ('Lindsay', 'Jone')])]
+        serial_index = PPRLIndexLambdaFold(config).build_reversed_index(data)
+        parallel_index = PPRLIndexLambdaFold(dict(config, workers=3)).build_reversed_index(data)
+        assert parallel_index == serial_index
+        assert list(parallel_index) == list(serial_index)
+
+        # without shared memory the workers read the CLKs from a temporary file
+        with mock.patch('blocklib.pprllambdafold.shared_memory', None):
+            file_index = PPRLIndexLambdaFold(dict(config, workers=3)).build_reversed_index(data)
+        assert list(file_index.items()) == list(serial_index.items())
+
+    def test_build_reversed_index_clk_file(self):
+        """Test building the inverted index from memory mapped binary CLK files."""
+        config = {
+            "blocking-features": [1, 2],
+            "Lambda": 5,
+            "bf-len": 1024,
+            "num-hash-funcs": 1000,
+            "K": 30,
+            "random_state": 0,
+            "input-clks": True,
+            "chunk-size": 3
+        }
+        clk_filepath = Path(__file__).parent / 'data' / 'small_clk.json'
+        with clk_filepath.open() as f:
+            data = json.load(f)['clks']
+        raw_clks = [base64.b64decode(clk) for clk in data]
+        reversed_index = PPRLIndexLambdaFold(config).build_reversed_index(data)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raw_path = os.path.join(tmpdir, 'clks.bin')
+            with open(raw_path, 'wb') as f:
+                f.write(b''.join(raw_clks))
+            npy_path = os.path.join(tmpdir, 'clks.npy')
+            np.save(npy_path, np.frombuffer(b''.join(raw_clks), dtype=np.uint8).reshape(len(raw_clks), -1))
+
+            assert PPRLIndexLambdaFold(config).build_reversed_index(raw_path) == reversed_index
+            assert PPRLIndexLambdaFold(config).build_reversed_index(Path(npy_path)) == reversed_index
+            assert PPRLIndexLambdaFold(dict(config, workers=2)).build_reversed_index(raw_path) == reversed_index
+
+            with self.assertRaises(ValueError):
+                PPRLIndexLambdaFold(dict(config, **{"bf-len": 1000})).build_reversed_index(raw_path)
 
     def test_header_with_feature_type(self):
         """Test different combination of header and feature column type."""
@@ -141,4 +239,24 @@ class TestLambdaFold(unittest.TestCase):
 
         # above 3 cases should give exactly same results
         assert reversed_index1 == reversed_index2
-        assert reversed_index2 == reversed_index3
\ No newline at end of file
+        assert reversed_index2 == reversed_index3
+
+    def test_records_to_bfs(self):
+        """Test the batch encoder gives the same bloom filters as encoding one record at a time."""
+        config = {
+                "blocking-features": [1, 2],
+                "Lambda": 5,
+                "bf-len": 2000,
+                "num-hash-funcs": 20,
+                "K": 30,
+                "random_state": 0,
+                "input-clks": False
+        }
+        lambdafold = PPRLIndexLambdaFold(config)
+        data = [[1, 'Xu', 'Li'], [2, 'Fred', 'Yu'], [3, '', 'J'], [4, 'Fred', 'Yu']]
+        packed = lambdafold.__records_to_bfs__(data, config['blocking-features'])
+        assert packed.shape == (4, 250)
+        assert packed.dtype == np.uint8
+        for record, row in zip(data, packed):
+            bloom_filter = lambdafold.__record_to_bf__(record, config['blocking-features'])
+            assert np.array_equal(np.packbits(bloom_filter), row)
@@ -1,5 +1,6 @@
 import unittest
 from blocklib import PPRLIndexPSignature, flip_bloom_filter
+from blocklib.encoding import positions_to_block_key
 
 data = [('id1', 'Joyce', 'Wang', 'Ashfield'),
         ('id2', 'Joyce', 'Hsu', 'Burwood'),
@@ -83,9 +84,9 @@ class TestPSig(unittest.TestCase):
         }
         psig = PPRLIndexPSignature(config)
         reversed_index = psig.build_reversed_index(data, verbose=True)
-        bf_set = tuple(flip_bloom_filter("0_Fred", config['blocking-filter']['bf-len'],
-                                         config['blocking-filter']['number-hash-functions']))
-        assert reversed_index == {str(bf_set): ['id4', 'id5']}
+        bf_set = positions_to_block_key(sorted(flip_bloom_filter("0_Fred", config['blocking-filter']['bf-len'],
+                                                                 config['blocking-filter']['number-hash-functions'])))
+        assert reversed_index == {bf_set: ['id4', 'id5']}
 
     def test_build_reversed_index_feature_name(self):
         """Test build revert index."""
@@ -114,9 +115,9 @@ class TestPSig(unittest.TestCase):
 
         psig = PPRLIndexPSignature(config)
         reversed_index = psig.build_reversed_index(data, verbose=True, header=header)
-        bf_set = tuple(flip_bloom_filter("0_Fred", config['blocking-filter']['bf-len'],
-                                         config['blocking-filter']['number-hash-functions']))
-        assert reversed_index == {str(bf_set): ['id4', 'id5']}
+        bf_set = positions_to_block_key(sorted(flip_bloom_filter("0_Fred", config['blocking-filter']['bf-len'],
+                                                                 config['blocking-filter']['number-hash-functions'])))
+        assert reversed_index == {bf_set: ['id4', 'id5']}
 
         # test if results with column name and column index are the same
         config_index = {
@@ -224,3 +225,35 @@ class TestPSig(unittest.TestCase):
         assert reversed_index1 == reversed_index2
         assert reversed_index2 == reversed_index3
 
+    def test_build_reversed_index_workers(self):
+        """Test building the index in a process pool gives exactly the serial result."""
+        records = [('id{}'.format(i), first, last) for i, (first, last) in enumerate(
+            [('Joyce', 'Wang'), ('Fred', 'Yu'), ('Joyce', 'Hsu'), ('Fred', 'Zhang'), ('Lindsay', 'Jone'),
+             ('Joyce', 'Shan'), ('Fred', 'Wang'), ('Li', 'Yu')])]
+        config = {
+            "blocking-features": [1, 2],
+            "record-id-col": 0,
+            "filter": {
+                "type": "ratio",
+                "max": 1.0,
+                "min": 0.0,
+            },
+            "blocking-filter": {
+                "type": "bloom filter",
+                "number-hash-functions": 4,
+                "bf-len": 64,
+            },
+            "signatureSpecs": [
+                [
+                    {"type": "feature-value", "feature": 1}
+                ],
+                [
+                    {"type": "characters-at", "config": {"pos": ["0:1"]}, "feature": 2},
+                    {"type": "metaphone", "feature": 1}
+                ]
+            ]
+        }
+        serial_index = PPRLIndexPSignature(config).build_reversed_index(records)
+        config['workers'] = 3
+        parallel_index = PPRLIndexPSignature(config).build_reversed_index(records)
+        assert list(parallel_index.items()) == list(serial_index.items())
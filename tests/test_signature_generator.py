@@ -1,5 +1,10 @@
+import copy
+
+import numpy as np
 import pytest
-from blocklib import generate_signatures
+from blocklib import generate_signatures, SignaturePlan
+from blocklib.signature_generator import SIGNATURE_STRATEGIES, DEFAULT_TRANSFORM_CACHE_SIZE, \
+    configure_transform_caches, get_transform_cache
 
 
 class TestPSig:
@@ -96,3 +101,74 @@ class TestPSig:
             feature_to_index = {'name': 0}
             generate_signatures(signatures, dtuple, feature_to_index)
             assert e == 'Feature name is not in the dataset'
+
+    def test_signature_plan(self):
+        """Test a compiled plan gives the same signatures and leaves the strategies untouched."""
+        strategies = [
+            [
+                {'type': 'characters-at', 'feature': 'firstname', 'config': {'pos': [':2', '-1']}},
+                {'type': 'feature-value', 'feature': 'zip'},
+            ],
+            [
+                {'type': 'metaphone', 'feature': 'lastname'},
+            ]
+        ]
+        original = copy.deepcopy(strategies)
+        feature_to_index = {'firstname': 0, 'lastname': 1, 'zip': 2}
+        plan = SignaturePlan(strategies, feature_to_index)
+        assert plan.generate(('Joyce', 'Wang', 2134)) == ['0_Joe_2134', '1_ANKFNK']
+        assert plan.generate(('', 'Smith', 2000)) == ['0_2000', '1_SM0XMT']
+        assert generate_signatures(strategies, ('Joyce', 'Wang', 2134), feature_to_index) == \
+            plan.generate(('Joyce', 'Wang', 2134))
+        assert strategies == original
+
+    def test_custom_strategy(self):
+        """Test strategies registered in SIGNATURE_STRATEGIES receive the stringified record."""
+        def generate_by_reverse(attr_ind, dtuple, suffix=''):
+            return dtuple[attr_ind][::-1] + suffix
+
+        SIGNATURE_STRATEGIES['reverse'] = generate_by_reverse
+        try:
+            strategies = [[{'type': 'reverse', 'feature': 1, 'config': {'suffix': '!'}}]]
+            assert SignaturePlan(strategies).generate(('Joyce', 2134)) == ['0_4312!']
+        finally:
+            del SIGNATURE_STRATEGIES['reverse']
+
+    def test_generate_columns(self):
+        """Test columnar signature generation agrees with generating signatures per record."""
+        data = [('Joyce', 'Wang', 2134), ('Joyce', 'Smith', 2000), ('', 'Schmidt', 2134), ('Fred', '', 2000)]
+        strategies = [
+            [
+                {'type': 'feature-value', 'feature': 0},
+            ],
+            [
+                {'type': 'characters-at', 'feature': 0, 'config': {'pos': [':2']}},
+                {'type': 'metaphone', 'feature': 1},
+                {'type': 'feature-value', 'feature': 2},
+            ]
+        ]
+        plan = SignaturePlan(strategies)
+        assert plan.columnar
+        assert plan.feature_indices == [0, 1, 2]
+        columns = {0: np.array([x[0] for x in data]), 1: [x[1] for x in data], 2: [x[2] for x in data]}
+        signature_columns = plan.generate_columns(columns)
+        assert [list(sigs) for sigs in zip(*signature_columns)] == [plan.generate(dtuple) for dtuple in data]
+
+    def test_metaphone_cache(self):
+        """Test phonetic encodings are served from the shared transform cache."""
+        cache = get_transform_cache('metaphone')
+        cache.clear()
+        strategies = [[{'type': 'metaphone', 'feature': 0}]]
+        plan = SignaturePlan(strategies)
+        for _ in range(3):
+            assert plan.generate(('Smith',)) == ['0_SM0XMT']
+        assert cache.info()['hits'] == 2
+        assert cache.info()['misses'] == 1
+
+        configure_transform_caches(1)
+        try:
+            plan.generate(('Schmidt',))
+            assert cache.info()['size'] == 1
+            assert cache.info()['evictions'] == 1
+        finally:
+            configure_transform_caches(DEFAULT_TRANSFORM_CACHE_SIZE)
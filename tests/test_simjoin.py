@@ -0,0 +1,67 @@
+import itertools
+import random
+
+import pytest
+
+from blocklib import similarity_join, iter_similarity_join
+from blocklib.simmeasure import DiceSim, EditSim, SimMeasure
+
+
+def brute_force_join(blocks, strings, sim_measure, threshold):
+    blocks_a, blocks_b = blocks
+    pairs = {(rec_a, rec_b) for key in blocks_a.keys() & blocks_b.keys()
+             for rec_a, rec_b in itertools.product(blocks_a[key], blocks_b[key])}
+    scores = {}
+    for rec_a, rec_b in pairs:
+        try:
+            scores[(rec_a, rec_b)] = sim_measure.sim(strings[0][rec_a], strings[1][rec_b])
+        except ZeroDivisionError:
+            # Dice similarity of distinct strings without q-grams
+            continue
+    return {pair: score for pair, score in scores.items() if score >= threshold}
+
+
+class TestSimilarityJoin:
+
+    def setup_method(self):
+        rng = random.Random(4)
+        self.strings = [[''.join(rng.choice('abcd') for _ in range(rng.randint(0, 10))) for _ in range(n)]
+                        for n in (60, 50)]
+        self.strings[1][:3] = self.strings[0][:3]
+        self.blocks = [{key: rng.sample(range(len(party_strings)), rng.randint(1, 15)) for key in range(8)}
+                       for party_strings in self.strings]
+
+    @pytest.mark.parametrize('threshold', [0.1, 0.5, 0.7, 0.9, 1.0])
+    @pytest.mark.parametrize('ngram_padding', [True, False])
+    def test_dice(self, threshold, ngram_padding):
+        sim = DiceSim(dict(ngram_len=2, ngram_padding=ngram_padding, padding_start_char='#', padding_end_char='$'))
+        expected = brute_force_join(self.blocks, self.strings, sim, threshold)
+        result = similarity_join(self.blocks, self.strings, sim, threshold)
+        assert len(result) == len(expected)
+        assert {(rec_a, rec_b): score for rec_a, rec_b, score in result} == expected
+
+    @pytest.mark.parametrize('threshold', [0.1, 0.5, 0.7, 1.0])
+    @pytest.mark.parametrize('min_threshold', [None, 0.05, 0.6])
+    @pytest.mark.parametrize('q', [1, 2, 3])
+    def test_edit(self, threshold, min_threshold, q):
+        sim = EditSim(dict(min_threshold=min_threshold))
+        expected = brute_force_join(self.blocks, self.strings, sim, threshold)
+        result = similarity_join(self.blocks, self.strings, sim, threshold, q=q)
+        assert {(rec_a, rec_b): score for rec_a, rec_b, score in result} == expected
+
+    def test_iter_blocks_input(self):
+        sim = EditSim({})
+        blocks = [(key, [self.blocks[0][key], self.blocks[1][key]]) for key in self.blocks[0]]
+        assert list(iter_similarity_join(blocks, self.strings, sim, 0.5)) == \
+            similarity_join(self.blocks, self.strings, sim, 0.5)
+
+    def test_other_measure(self):
+        class PrefixSim(SimMeasure):
+            def sim(self, s1, s2, cache=False):
+                return 1.0 if s1[:1] == s2[:1] else 0.0
+
+        sim = PrefixSim()
+        expected = brute_force_join(self.blocks, self.strings, sim, 1.0)
+        assert {(a, b): s for a, b, s in similarity_join(self.blocks, self.strings, sim, 1.0)} == expected
+        with pytest.raises(ValueError):
+            similarity_join(self.blocks, self.strings, sim, 0)
@@ -1,3 +1,4 @@
+import random
 import time
 import pytest
 from blocklib.simmeasure import EditSim, DiceSim
@@ -31,6 +32,21 @@ def test_editsim():
     assert score1 > score2
 
 
+@pytest.mark.parametrize('min_threshold', [None, 0.0, 0.3, 0.5, 0.8, 1.0])
+def test_editsim_sim_many(min_threshold):
+    """Test the bit-parallel batch edit similarity against the scalar one."""
+    rng = random.Random(min_threshold)
+    words = [''.join(rng.choice('abcd') for _ in range(rng.randint(0, 12))) for _ in range(60)]
+    pairs = [(rng.choice(words), rng.choice(words)) for _ in range(500)] + [('Joyce', 'Joyce'), ('', 'a')]
+    sim = EditSim(dict(min_threshold=min_threshold))
+    expected = [sim.sim(s1, s2) for s1, s2 in pairs]
+    assert sim.sim_many(pairs) == expected
+    assert sim.sim_many(iter(pairs), workers=2) == expected
+
+    with pytest.raises(ValueError):
+        EditSim(dict(min_threshold=1.1)).sim_many([('Joyce', 'Joycee')])
+
+
 def test_dicesim():
     """Test Dice similarity measure."""
     config = dict(ngram_len=2, ngram_padding=1, padding_start_char='a', padding_end_char='z')
@@ -53,4 +69,71 @@ def test_dicesim():
     s2 = 'Jo is'
     score_dice = sim.sim(s1, s2, cache=True)
     score_edit = EditSim({}).sim(s1, s2)
-    assert score_dice > score_edit
\ No newline at end of file
+    assert score_dice > score_edit
+
+
+def test_dicesim_caches():
+    """Test bounded, symmetric and shared DiceSim caches."""
+    config = dict(ngram_len=2, ngram_padding=1, padding_start_char='a', padding_end_char='z',
+                  q_gram_cache_size=2, sim_cache_size=1)
+    sim = DiceSim(config)
+    score = sim.sim('Joyce', 'Joyee', cache=True)
+    # the pair is cached once for both orders
+    assert sim.sim('Joyee', 'Joyce', cache=True) == score
+    stats = sim.cache_stats()
+    assert stats['sim_cache']['hits'] == 1 and stats['sim_cache']['size'] == 1
+    assert stats['q_gram_cache']['size'] == 2
+
+    sim.sim('Fred', 'Fredrick', cache=True)
+    stats = sim.cache_stats()
+    assert stats['sim_cache']['evictions'] == 1
+    assert stats['q_gram_cache']['evictions'] == 2
+    assert len(sim.q_gram_cache) == 2 and len(sim.sim_cache) == 1
+
+    # shared caches are reused by instances with the same q-gram parameters only
+    shared = dict(config, cache_scope='shared')
+    assert DiceSim(shared).sim_cache is DiceSim(shared).sim_cache
+    assert DiceSim(shared).sim_cache is not DiceSim(dict(shared, ngram_len=3)).sim_cache
+    assert DiceSim(config).sim_cache is not DiceSim(config).sim_cache
+
+    # new instances never shrink a shared cache and evict the entries of others
+    base = dict(ngram_len=2, ngram_padding=1, padding_start_char='b', padding_end_char='y', cache_scope='shared')
+    large = DiceSim(dict(base, q_gram_cache_size=1000))
+    for i in range(500):
+        large.sim('Joyce{}'.format(i), 'Fred', cache=True)
+    num_entries = len(large.q_gram_cache)
+    assert DiceSim(base).q_gram_cache is large.q_gram_cache
+    assert DiceSim(dict(base, q_gram_cache_size=10)).q_gram_cache is large.q_gram_cache
+    assert large.q_gram_cache.maxsize == 1000 and len(large.q_gram_cache) == num_entries == 501
+    assert DiceSim(dict(base, q_gram_cache_size=2000)).q_gram_cache.maxsize == 2000
+
+    with pytest.raises(ValueError):
+        DiceSim(dict(config, cache_scope='global'))
+
+
+@pytest.mark.parametrize('ngram_padding', [True, False])
+def test_dicesim_sim_block(ngram_padding):
+    """Test all-pairs Dice similarity of a block against the scalar one."""
+    config = dict(ngram_len=2, ngram_padding=ngram_padding, padding_start_char='a', padding_end_char='z')
+    sim = DiceSim(config)
+    rng = random.Random(3)
+    strings_a = [''.join(rng.choice('abc') for _ in range(rng.randint(2, 6))) for _ in range(40)] + ['aaa', 'x']
+    strings_b = [''.join(rng.choice('abc') for _ in range(rng.randint(2, 6))) for _ in range(30)] + ['aaa', 'x']
+
+    threshold = 0.4
+    pos_a, pos_b, sims = sim.sim_block(strings_a, strings_b, threshold)
+    expected = {(i, j): sim.sim(s1, s2) for i, s1 in enumerate(strings_a) for j, s2 in enumerate(strings_b)}
+    expected = {pair: score for pair, score in expected.items() if score >= threshold}
+    assert dict(zip(zip(pos_a.tolist(), pos_b.tolist()), sims.tolist())) == expected
+    assert list(zip(pos_a.tolist(), pos_b.tolist())) == sorted(expected)
+
+    # blocks are streamed with record IDs
+    blocks = [('k1', [[0, 1, 40], [3, 30]]), ('k2', [[41], []])]
+    results = list(sim.iter_block_sims(blocks, [strings_a, strings_b], threshold))
+    assert [key for key, _, _, _ in results] == ['k1', 'k2']
+    _, recs_a, recs_b, sims = results[0]
+    assert list(zip(recs_a, recs_b)) == [(i, j) for i, j in sorted(expected) if i in (0, 1, 40) and j in (3, 30)]
+    assert len(results[1][3]) == 0
+
+    with pytest.raises(ValueError):
+        sim.sim_block(strings_a, strings_b, 0)
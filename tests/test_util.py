@@ -1,4 +1,13 @@
-from blocklib.stats import reversed_index_per_strategy_stats, reversed_index_stats
+import base64
+import json
+import statistics
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from blocklib.stats import estimate_candidate_pairs, reversed_index_per_strategy_stats, reversed_index_stats
+from blocklib.utils import deserialize_filters, deserialize_filters_to_array
 
 
 def test_reversed_index_per_strategy_stats_empty():
@@ -20,4 +29,43 @@ def test_reversed_index_stats():
     assert stats['med_size'] == 2
     assert stats['avg_size'] == 10/3
     assert stats['sum_of_blocks'] == 10
+    assert stats['std_size'] == pytest.approx(statistics.stdev([1, 2, 7]))
+
+
+def test_estimate_candidate_pairs():
+    # pair (1, 'a') is in both block x and y, 3 parties in block z
+    blocks_a = {'x': [1, 2], 'y': [1], 'z': [3], 'only_a': [4, 5]}
+    blocks_b = {'x': ['a'], 'y': ['a', 'b'], 'z': ['c']}
+    blocks_c = {'z': [True, False]}
+    estimate = estimate_candidate_pairs([blocks_a, blocks_b, blocks_c], top_n=2, random_state=0)
+    assert estimate['num_block_pairs'] == 2 + 2 + 5
+    assert estimate['top_blocks'] == [('z', 5), ('x', 2)]
+    assert estimate['est_distinct_pairs'] == pytest.approx(8, rel=0.1)
+
+    # without shared records the estimate is exact
+    estimate = estimate_candidate_pairs([{'x': [1, 2], 'y': [3]}, {'x': [1], 'y': [2, 3]}])
+    assert estimate['est_distinct_pairs'] == estimate['num_block_pairs'] == 4
+    assert estimate_candidate_pairs([{'x': [1]}, {'y': [1]}])['num_block_pairs'] == 0
+
+    # a record listed twice in a block is compared once
+    estimate = estimate_candidate_pairs([{'x': [1, 1, 2], 'y': [1]}, {'x': ['a'], 'y': ['a']}], random_state=0)
+    assert estimate['num_block_pairs'] == 3
+    assert estimate['top_blocks'][0] == ('x', 2)
+    assert estimate['est_distinct_pairs'] == pytest.approx(2, rel=0.1)
+
+
+def test_deserialize_filters_to_array():
+    clk_filepath = Path(__file__).parent / 'data' / 'small_clk.json'
+    with clk_filepath.open() as f:
+        clks = json.load(f)['clks']
+    clk_array = deserialize_filters_to_array(clks)
+    assert clk_array.shape == (len(clks), 128)
+    for row, ba in zip(clk_array, deserialize_filters(clks)):
+        assert row.tobytes() == ba.tobytes()
+
+    # raw bytes are used as they are
+    raw_clks = [base64.b64decode(clk) for clk in clks]
+    assert np.array_equal(deserialize_filters_to_array(raw_clks), clk_array)
 
+    with pytest.raises(ValueError):
+        deserialize_filters_to_array([raw_clks[0], raw_clks[1][:-1]])